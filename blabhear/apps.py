@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
 
 
 class BlabhearConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'blabhear'
+
+    def ready(self):
+        from blabhear.metrics import install_query_metrics
+
+        if settings.METRICS_ENABLED:
+            connection_created.connect(install_query_metrics)
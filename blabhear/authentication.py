@@ -1,69 +1,98 @@
+import hashlib
 import logging
-import os
+import threading
+import time
 from urllib.parse import parse_qs
 
-import firebase_admin
+from cachetools import TLRUCache
 from channels.auth import AuthMiddlewareStack
-from channels.db import database_sync_to_async
-from firebase_admin import auth, credentials
+from django.conf import settings
 
-from blabhear.exceptions import InvalidFirebaseAuthToken, FirebaseAuthError
+from blabhear.exceptions import FirebaseAuthError
+from blabhear.executors import database_sync_to_async
+from blabhear.metrics import registry
 from blabhear.models import User
+from blabhear.tokens import firebase_keys, verify_id_token
 
 logger = logging.getLogger(__name__)
-cred = credentials.Certificate(
-    {
-        "type": "service_account",
-        "project_id": os.environ.get("FIREBASE_PROJECT_ID"),
-        "private_key_id": os.environ.get("FIREBASE_PRIVATE_KEY_ID"),
-        "private_key": os.environ.get("FIREBASE_PRIVATE_KEY").replace("\\n", "\n"),
-        "client_email": os.environ.get("FIREBASE_CLIENT_EMAIL"),
-        "client_id": os.environ.get("FIREBASE_CLIENT_ID"),
-        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-        "token_uri": "https://accounts.google.com/o/oauth2/token",
-        "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-        "client_x509_cert_url": os.environ.get("FIREBASE_CLIENT_CERT_URL"),
-    }
+
+
+def token_expiry(digest, decoded_token, now):
+    # Never serve a token past its own exp, however long the cache TTL is.
+    return min(now + settings.TOKEN_CACHE_TTL, decoded_token.get("exp", now))
+
+
+verified_tokens = TLRUCache(
+    maxsize=settings.TOKEN_CACHE_MAXSIZE, ttu=token_expiry, timer=time.time
 )
+verified_tokens_lock = threading.Lock()
 
-default_app = firebase_admin.initialize_app(cred)
 
+def count_metric(name):
+    if settings.METRICS_ENABLED:
+        registry.inc(name, ())
 
-@database_sync_to_async
-def get_user(token):
-    try:
-        decoded_token = auth.verify_id_token(token)
-    except auth.RevokedIdTokenError as exc:
-        raise InvalidFirebaseAuthToken(str(exc))
-    except auth.UserDisabledError as exc:
-        raise InvalidFirebaseAuthToken(str(exc))
-    except auth.InvalidIdTokenError as exc:
-        raise InvalidFirebaseAuthToken(str(exc))
 
+def token_digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def verify_token(token):
+    digest = token_digest(token)
+    with verified_tokens_lock:
+        decoded_token = verified_tokens.get(digest)
+    if decoded_token is not None:
+        count_metric("blabhear_token_cache_hits_total")
+        return decoded_token
+    count_metric("blabhear_token_cache_misses_total")
+
+    decoded_token = verify_id_token(token)
+
+    with verified_tokens_lock:
+        verified_tokens[digest] = decoded_token
+    return decoded_token
+
+
+@database_sync_to_async
+def get_user(decoded_token):
     try:
         uid = decoded_token.get("uid")
     except Exception:
         raise FirebaseAuthError("Missing uid.")
 
+    phone_number = decoded_token.get("phone_number") or ""
+    user = User.objects.filter(username=uid).first()
+    if user is not None and user.phone_number == phone_number:
+        count_metric("blabhear_user_upserts_skipped_total")
+        return user
+
     user, created = User.objects.update_or_create(
         username=uid,
         defaults={
-            "phone_number": decoded_token.get("phone_number") or "",
+            "phone_number": phone_number,
         },
     )
     return user
 
 
 class TokenAuthMiddleware:
-    def __init__(self, app):
+    def __init__(self, app, verify_token=None):
         self.app = app
+        # The load test passes a stub here so it can run without Firebase.
+        self.verify_token = verify_token
 
     async def __call__(self, scope, receive, send):
-        scope["user"] = await get_user(
-            parse_qs(scope["query_string"].decode())["token"][0]
-        )
+        token = parse_qs(scope["query_string"].decode())["token"][0]
+        if self.verify_token is None:
+            await firebase_keys.ready()
+            # Signature checks are CPU only, so they run on the event loop and
+            # the database thread is only used for the user lookup.
+            decoded_token = verify_token(token)
+        else:
+            decoded_token = self.verify_token(token)
+        scope["user"] = await get_user(decoded_token)
         return await self.app(scope, receive, send)
 
 
-def TokenAuthMiddlewareStack(app):
-    return TokenAuthMiddleware(AuthMiddlewareStack(app))
+def TokenAuthMiddlewareStack(app, verify_token=None):
+    return TokenAuthMiddleware(AuthMiddlewareStack(app), verify_token=verify_token)
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+async def group_send_many(channel_layer, groups, message):
+    groups = list(dict.fromkeys(groups))
+    if not groups:
+        return
+    if hasattr(channel_layer, "group_send_many"):
+        # blabhear.layers.RedisChannelLayer batches the whole fan-out.
+        await channel_layer.group_send_many(groups, message)
+        return
+    # Elsewhere each group still gets its own group_send, but a batch of them
+    # is in flight at once instead of awaiting every publish in turn.
+    batch_size = settings.BROADCAST_BATCH_SIZE
+    for start in range(0, len(groups), batch_size):
+        await asyncio.gather(
+            *(
+                channel_layer.group_send(group, message)
+                for group in groups[start : start + batch_size]
+            )
+        )
+
+
+# Facets a room_refresh can carry, with the legacy event each one replaces,
+# in the order older clients used to receive them.
+ROOM_REFRESH_EVENTS = {
+    "display_name": "refresh_display_name",
+    "join_requests": "refresh_join_requests",
+    "members": "refresh_members",
+    "allowed_status": "refresh_allowed_status",
+    "privacy": "refresh_privacy",
+    "upload_url": "refresh_upload_url",
+    "message_notifications": "refresh_message_notifications",
+    "notified": "room_notified",
+}
+
+
+class RoomRefresher:
+    def __init__(self):
+        self.pending = {}
+        self.flushes = {}
+        # Flushes stay referenced until they finish, including the group_send
+        # after they leave self.flushes.
+        self.running = set()
+
+    def mark(self, room_id, facets, usernames=None):
+        # usernames limits the facets to those members; None means everyone.
+        pending = self.pending.setdefault(room_id, {})
+        for facet in facets:
+            if facet in pending and pending[facet] is None:
+                continue
+            if usernames is None:
+                pending[facet] = None
+            else:
+                pending[facet] = pending.get(facet, set()) | set(usernames)
+        if room_id not in self.flushes:
+            task = asyncio.create_task(self.flush_later(room_id))
+            self.flushes[room_id] = task
+            self.running.add(task)
+            task.add_done_callback(self.flushed)
+
+    async def flush_later(self, room_id):
+        try:
+            await asyncio.sleep(settings.ROOM_REFRESH_DEBOUNCE)
+        finally:
+            del self.flushes[room_id]
+            pending = self.pending.pop(room_id)
+        await get_channel_layer().group_send(
+            room_id,
+            {
+                "type": "room_refresh",
+                "facets": {
+                    facet: None if usernames is None else sorted(usernames)
+                    for facet, usernames in pending.items()
+                },
+            },
+        )
+
+    def flushed(self, task):
+        self.running.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Room refresh failed", exc_info=task.exception())
+
+
+room_refresher = RoomRefresher()
@@ -1,10 +1,23 @@
-import asyncio
 import logging
-from operator import itemgetter
+from urllib.parse import parse_qs
 
-from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Value, When
+from django.utils import timezone
+
+from blabhear.broadcast import ROOM_REFRESH_EVENTS, group_send_many, room_refresher
+from blabhear.deltas import (
+    LEGACY_DELTA_EVENTS,
+    join_requests_delta,
+    members_delta,
+    room_delta,
+)
+from blabhear.dispatch import DirectDispatchConsumer
+from blabhear.executors import database_sync_to_async
+from blabhear.inbox import sync_room_inbox
+from blabhear.instrumentation import InstrumentedConsumer
 from blabhear.models import (
     Room,
     JoinRequest,
@@ -12,227 +25,470 @@ from blabhear.models import (
     UserNotification,
     Message,
     MessageNotification,
+    RoomInbox,
+)
+from blabhear.pagination import PagedConsumer, paginate
+from blabhear.reads import async_reads
+from blabhear.room_cache import ROOM_METADATA_FACETS, room_cache
+from blabhear.scheduler import ScheduledConsumer
+from blabhear.serializers import (
+    serialize_message_notification,
+    serialize_user_notification,
 )
 from blabhear.storage import (
-    generate_upload_signed_url_v4,
-    generate_download_signed_url_v4,
+    SIGNED_URL_REFRESH_IN,
+    generate_upload_signed_url_v4_async,
+    generate_download_signed_urls_v4_async,
 )
 
 logger = logging.getLogger(__name__)
 
+APPROVAL_FACETS = ["allowed_status", "privacy", "upload_url", "notified"]
+
+
+class RoomConsumer(
+    ScheduledConsumer,
+    PagedConsumer,
+    DirectDispatchConsumer,
+    InstrumentedConsumer,
+    AsyncJsonWebsocketConsumer,
+):
+    metrics_name = "room"
+    commands = frozenset(
+        [
+            "connect",
+            "disconnect",
+            "fetch_allowed_status",
+            "update_privacy",
+            "fetch_privacy",
+            "fetch_join_requests",
+            "fetch_members",
+            "reject_user",
+            "approve_user",
+            "approve_all_users",
+            "update_display_name",
+            "fetch_display_name",
+            "read_room_notification",
+            "fetch_upload_url",
+            "send_message",
+            "fetch_message_notifications",
+            "read_message_notification",
+            "resync",
+        ]
+    )
+    mutating_commands = frozenset(
+        [
+            "fetch_allowed_status",
+            "update_privacy",
+            "reject_user",
+            "approve_user",
+            "approve_all_users",
+            "update_display_name",
+            "read_room_notification",
+            "send_message",
+            "read_message_notification",
+        ]
+    )
 
-class RoomConsumer(AsyncJsonWebsocketConsumer):
     def get_room(self, room_id):
         room, created = Room.objects.get_or_create(id=room_id)
         return room
 
-    def get_all_room_members(self):
-        room = Room.objects.filter(id=self.room_id)
-        if room.exists():
-            room = room.first()
-            members = room.members.all().values()
-        else:
-            members = []
-        member_display_names = [user["display_name"] for user in members]
-        member_usernames = [user["username"] for user in members]
-        return member_display_names, member_usernames
-
-    def add_user_to_room(self, user, room):
-        was_added = False
-        if user not in room.members.all():
-            room.members.add(user)
-            UserNotification.objects.get_or_create(
-                user=user,
-                room=room,
-            )
-            was_added = True
-        member_display_names, member_usernames = self.get_all_room_members()
-        return member_display_names, was_added
+    def lock_room(self, room_id):
+        # Write paths lock the room row first, so concurrent writers to one
+        # room queue behind each other instead of deadlocking on its rows.
+        room, created = Room.objects.select_for_update().get_or_create(id=room_id)
+        return room
 
     def set_room_privacy(self, private):
-        room = self.get_room(self.room_id)
-        room.private = private
-        room.save()
-
-    def user_not_allowed(self):
-        room = Room.objects.filter(id=self.room_id)
-        if room.exists():
-            room = room.first()
-            return self.user not in room.members.all() and room.private
-        else:
-            return False
+        with transaction.atomic():
+            room = self.lock_room(self.room_id)
+            room.private = private
+            room.save()
+            return room_delta(room.id, "privacy", privacy=room.private)
 
     def get_all_join_requests(self):
         room = self.get_room(self.room_id)
-        all_join_requests = list(
-            room.joinrequest_set.order_by("-timestamp").values(
-                "user", "user__username", "user__display_name"
-            )
+        return self.get_all_join_requests_for(room)
+
+    def join_requests_queryset(self, room):
+        return room.joinrequest_set.order_by("-timestamp").values(
+            "user", "user__username", "user__display_name"
         )
+
+    def get_all_join_requests_for(self, room):
+        all_join_requests = list(self.join_requests_queryset(room))
         return all_join_requests
 
     def get_message(self):
-        room = self.get_room(self.room_id)
-        message, created = Message.objects.get_or_create(room=room, creator=self.user)
+        # The room was created when this socket connected.
+        message, created = Message.objects.get_or_create(
+            room_id=self.room_id, creator=self.user
+        )
         return message
 
     def get_or_create_new_join_request(self):
-        room = self.get_room(self.room_id)
-        JoinRequest.objects.get_or_create(user=self.user, room=room)
+        with transaction.atomic():
+            room = self.lock_room(self.room_id)
+            join_request, created = JoinRequest.objects.get_or_create(
+                user=self.user, room=room
+            )
+            if created:
+                return [join_requests_delta(room.id)]
+        return []
 
     def reject_room_member(self, username):
         user = User.objects.get(username=username)
-        room = self.get_room(self.room_id)
-        room.joinrequest_set.filter(user=user).delete()
+        with transaction.atomic():
+            room = self.lock_room(self.room_id)
+            room.joinrequest_set.filter(user=user).delete()
+            return join_requests_delta(room.id)
 
     def approve_room_member(self, username):
         user = User.objects.get(username=username)
-        room = self.get_room(self.room_id)
-        room.members.add(user)
-        UserNotification.objects.get_or_create(
-            user=user,
-            room=room,
-        )
-        room.joinrequest_set.filter(user=user).delete()
-
-    def approve_all_room_members(self):
-        added_users = []
-        room = self.get_room(self.room_id)
-        for request in room.joinrequest_set.all():
-            room.members.add(request.user)
+        with transaction.atomic():
+            room = self.lock_room(self.room_id)
+            room.members.add(user)
             UserNotification.objects.get_or_create(
-                user=request.user,
+                user=user,
                 room=room,
             )
-            added_users.append(request.user.username)
-        room.joinrequest_set.all().delete()
-        return added_users
+            sync_room_inbox(room.id, [user.id])
+            room.joinrequest_set.filter(user=user).delete()
+            return [members_delta(room.id), join_requests_delta(room.id)]
+
+    def approve_all_room_members(self):
+        with transaction.atomic():
+            room = self.lock_room(self.room_id)
+            requesters = list(User.objects.filter(joinrequest__room=room))
+            room.members.add(*requesters)
+            UserNotification.objects.bulk_create(
+                [UserNotification(user=user, room=room) for user in requesters],
+                ignore_conflicts=True,
+            )
+            sync_room_inbox(room.id, [user.id for user in requesters])
+            room.joinrequest_set.filter(user__in=requesters).delete()
+            deltas = [members_delta(room.id), join_requests_delta(room.id)]
+        return [user.username for user in requesters], deltas
 
     def change_display_name(self, new_name):
-        room = self.get_room(self.room_id)
-        room.display_name = new_name
-        room.save()
+        with transaction.atomic():
+            room = self.lock_room(self.room_id)
+            room.display_name = new_name
+            room.save()
+            RoomInbox.objects.filter(room=room).update(room_display_name=new_name)
+            delta = room_delta(room.id, "display_name", display_name=new_name)
         users_to_refresh = [
             str(user["username"]) for user in room.members.all().values()
         ]
-        return new_name, users_to_refresh
+        return new_name, users_to_refresh, delta
 
     def read_unread_room_notification(self):
         room = self.get_room(self.room_id)
-        room_notification = UserNotification.objects.get(user=self.user, room=room)
-        if not room_notification.read:
-            room_notification.read = True
-            room_notification.save()
-
-    def read_unread_message_notification(self, notification_id):
-        message_notification = MessageNotification.objects.get(id=notification_id)
-        message_notification.read = True
-        message_notification.save()
-
-    def create_user_notifications_for_new_message(self):
-        room = self.get_room(self.room_id)
-        for user in room.members.all():
-            notification = UserNotification.objects.get(user=user, room=room)
-            message, created = Message.objects.get_or_create(
-                room=room, creator=self.user
+        with transaction.atomic():
+            room_notification = UserNotification.objects.get(user=self.user, room=room)
+            if not room_notification.read:
+                room_notification.read = True
+                room_notification.save()
+                sync_room_inbox(room.id, [self.user.id])
+
+    def read_unread_message_notification(self, notification_id=None, message_id=None):
+        # Deltas carry no notification ids, so clients may name the message
+        # instead; either way only the user's own notification is found.
+        if notification_id is not None:
+            lookup = {"id": notification_id}
+        else:
+            lookup = {"room_id": self.room_id, "message_id": message_id}
+        with transaction.atomic():
+            message_notification = MessageNotification.objects.get(
+                receiver=self.user, **lookup
+            )
+            message_notification.read = True
+            message_notification.save()
+            sync_room_inbox(
+                message_notification.room_id, [message_notification.receiver_id]
             )
-            notification.message = message
-            notification.read = user == self.user
-            notification.save()
 
-    def create_message_notifications_for_new_message(self):
-        room = self.get_room(self.room_id)
-        for user in room.members.all():
+    def record_new_message(self):
+        with transaction.atomic():
+            room = self.lock_room(self.room_id)
             message, created = Message.objects.get_or_create(
                 room=room, creator=self.user
             )
-            notification, created = MessageNotification.objects.get_or_create(
-                receiver=user, room=room, message=message
+            members = list(room.members.values_list("id", "username"))
+            member_ids = [member_id for member_id, username in members]
+            now = timezone.now()
+
+            UserNotification.objects.bulk_create(
+                [
+                    UserNotification(user_id=member_id, room=room)
+                    for member_id in member_ids
+                ],
+                ignore_conflicts=True,
+            )
+            user_notifications = UserNotification.objects.filter(
+                room=room, user_id__in=member_ids
+            )
+            user_notifications.update(
+                message=message,
+                read=Case(
+                    When(user_id=self.user.id, then=Value(True)),
+                    default=Value(False),
+                ),
+                timestamp=now,
             )
-            notification.read = user == self.user
-            notification.save()
 
-    def get_message_notifications(self):
-        room = self.get_room(self.room_id)
-        room_member_pks = room.members.all().values_list("pk", flat=True)
-        notifications = list(
-            self.user.messagenotification_set.filter(
-                room__id=self.room_id, message__creator__id__in=room_member_pks
+            MessageNotification.objects.bulk_create(
+                [
+                    MessageNotification(
+                        receiver_id=member_id, room=room, message=message
+                    )
+                    for member_id in member_ids
+                ],
+                ignore_conflicts=True,
+            )
+            message_notifications = MessageNotification.objects.filter(
+                room=room, message=message, receiver_id__in=member_ids
             )
-            .values(
-                "id",
-                "message__id",
-                "read",
-                "timestamp",
-                "message__creator__display_name",
+            message_notifications.update(
+                read=Case(
+                    When(receiver_id=self.user.id, then=Value(True)),
+                    default=Value(False),
+                ),
+                timestamp=now,
+            )
+            sync_room_inbox(room.id)
+            message_notification = serialize_message_notification(
+                {
+                    "id": None,
+                    "message__id": message.id,
+                    "read": False,
+                    "timestamp": now,
+                    "message__creator__display_name": self.user.display_name,
+                }
             )
-            .order_by("-timestamp")
+            # id and read differ per receiver, see own_message_notification.
+            del message_notification["id"], message_notification["read"]
+            delta = room_delta(
+                room.id,
+                "message_notification",
+                message_notification=message_notification,
+                sender=self.user.username,
+            )
+        return [username for member_id, username in members], delta
+
+    def message_notifications_queryset(self):
+        room_member_pks = Room.members.through.objects.filter(
+            room_id=self.room_id
+        ).values("user_id")
+        return self.user.messagenotification_set.filter(
+            room__id=self.room_id, message__creator__id__in=room_member_pks
+        ).values(
+            "id",
+            "message__id",
+            "read",
+            "timestamp",
+            "message__creator__display_name",
         )
-        notifications.sort(key=itemgetter("timestamp"), reverse=True)
-        notifications.sort(key=itemgetter("read"))
-        for notification in notifications:
-            notification["id"] = str(notification["id"])
-            notification["message__id"] = str(notification["message__id"])
-            notification["readable_timestamp"] = notification["timestamp"].strftime(
-                "%d-%m-%Y %H:%M:%S"
+
+    def get_message_notifications(self, cursor=None, page_size=None):
+        notifications, next_cursor = paginate(
+            self.message_notifications_queryset(), cursor, page_size
+        )
+        return list(map(serialize_message_notification, notifications)), next_cursor
+
+    def read_room_state(self, room):
+        members = list(room.members.values("username", "display_name"))
+        join_requests = self.get_all_join_requests_for(room)
+        for request in join_requests:
+            request["user"] = str(request["user"])
+        return {
+            "sequence": room.sequence,
+            "members": [member["display_name"] for member in members],
+            "member_usernames": [member["username"] for member in members],
+            "display_name": room.display_name,
+            "privacy": room.private,
+            "join_requests": join_requests,
+        }
+
+    def get_room_snapshot(self, join=True):
+        # Without join this only reads, and a room that no longer exists looks
+        # like the empty public room connecting would create.
+        if join:
+            room = self.get_room(self.room_id)
+        else:
+            room = Room.objects.filter(id=self.room_id).first() or Room(
+                id=self.room_id, display_name=self.room_id
             )
-            notification["timestamp"] = str(notification["timestamp"])
-            notification["url"] = generate_download_signed_url_v4(
-                notification["message__id"]
+        # The room row is read before its members, so a change landing in
+        # between is replayed by a delta the client has not seen yet.
+        snapshot = self.read_room_state(room)
+        is_member = self.user.username in snapshot["member_usernames"]
+        snapshot.update(
+            {"allowed": is_member or not room.private, "was_added": False, "deltas": []}
+        )
+        if not snapshot["allowed"]:
+            if join:
+                snapshot["deltas"] = self.get_or_create_new_join_request()
+            return snapshot
+        if join and not is_member:
+            with transaction.atomic():
+                room = self.lock_room(room.id)
+                room.members.add(self.user)
+                UserNotification.objects.get_or_create(user=self.user, room=room)
+                sync_room_inbox(room.id, [self.user.id])
+                snapshot["deltas"].append(members_delta(room.id))
+                # Re-read under the lock, so the snapshot is the room exactly
+                # as of the join's own delta.
+                room.refresh_from_db()
+                snapshot.update(self.read_room_state(room))
+            snapshot["was_added"] = True
+        if join:
+            with transaction.atomic():
+                if UserNotification.objects.filter(
+                    user=self.user, room=room, read=False
+                ).update(read=True, timestamp=timezone.now()):
+                    sync_room_inbox(room.id, [self.user.id])
+        (
+            snapshot["message_notifications"],
+            snapshot["next_cursor"],
+        ) = self.get_message_notifications(page_size=self.page_size({}))
+        return snapshot
+
+    def join_room(self):
+        snapshot = self.get_room_snapshot()
+        if snapshot["allowed"]:
+            snapshot["upload_blob"] = str(self.get_message().id)
+        return snapshot
+
+    def get_resync_snapshot(self):
+        snapshot = self.get_room_snapshot(join=False)
+        if snapshot["allowed"]:
+            # A socket that was let in after connecting may not have an
+            # upload destination yet; fetch_upload_url creates it.
+            snapshot["upload_blob"] = (
+                Message.objects.filter(room_id=self.room_id, creator=self.user)
+                .values_list("id", flat=True)
+                .first()
             )
+        return snapshot
+
+    async def sign_message_notifications(self, notifications):
+        urls = await generate_download_signed_urls_v4_async(
+            list({notification["message__id"] for notification in notifications})
+        )
+        for notification in notifications:
+            notification["url"] = urls[notification["message__id"]]
         return notifications
 
     async def connect(self):
         await self.accept()
         self.user = self.scope["user"]
+        self.snapshot_protocol = False
+        self.room_refresh_protocol = False
+        self.delta_protocol = False
+        self.paging_protocol = False
+        self.allowed_status = None
 
     async def initialize_room(self):
         await self.channel_layer.group_add(self.room_id, self.channel_name)
-        room = await database_sync_to_async(self.get_room)(self.room_id)
-        user_not_allowed = await database_sync_to_async(self.user_not_allowed)()
-        if user_not_allowed:
-            await self.channel_layer.send(
-                self.channel_name,
-                {"type": "allowed", "allowed": False, "room": self.room_id},
-            )
-            await database_sync_to_async(self.get_or_create_new_join_request)()
-            await self.channel_layer.group_send(
-                self.room_id,
-                {"type": "refresh_join_requests"},
-            )
-        else:
-            await self.channel_layer.send(
-                self.channel_name,
-                {"type": "allowed", "allowed": True, "room": self.room_id},
-            )
-            members, was_added = await database_sync_to_async(self.add_user_to_room)(
-                self.user, room
-            )
-            if was_added:
-                await self.channel_layer.group_send(
-                    self.room_id,
-                    {"type": "refresh_members"},
-                )
-                await self.channel_layer.group_send(
-                    self.room_id,
-                    {"type": "refresh_message_notifications"},
+        snapshot = await database_sync_to_async(self.join_room)()
+        self.allowed_status = snapshot["allowed"]
+        if not snapshot["allowed"]:
+            if self.snapshot_protocol:
+                await self.send_to_self(
+                    {"type": "room_snapshot", "allowed": False, "room": self.room_id}
                 )
             else:
-                await self.channel_layer.send(
-                    self.channel_name, {"type": "members", "members": members}
+                await self.send_to_self(
+                    {"type": "allowed", "allowed": False, "room": self.room_id}
                 )
-            await database_sync_to_async(self.read_unread_room_notification)()
+            await self.send_deltas(snapshot["deltas"])
+            return
+        await self.send_deltas(snapshot["deltas"])
+        if snapshot["was_added"]:
             await self.channel_layer.group_send(
-                self.user.username,
-                {
-                    "type": "refresh_notifications",
-                },
+                self.room_id,
+                {"type": "refresh_message_notifications"},
             )
-            await self.fetch_display_name()
-            await self.fetch_privacy()
-            await self.fetch_join_requests()
-            await self.fetch_upload_url()
-            await self.fetch_message_notifications()
+        await self.channel_layer.group_send(
+            self.user.username,
+            {
+                "type": "refresh_notifications",
+            },
+        )
+        message_notifications = await self.sign_message_notifications(
+            snapshot["message_notifications"]
+        )
+        upload_url = await generate_upload_signed_url_v4_async(snapshot["upload_blob"])
+        if self.snapshot_protocol:
+            await self.send_room_snapshot(snapshot, message_notifications, upload_url)
+            return
+        # Older clients get the same data as the individual message types.
+        legacy_messages = [{"type": "allowed", "allowed": True, "room": self.room_id}]
+        if not snapshot["was_added"]:
+            legacy_messages.append({"type": "members", "members": snapshot["members"]})
+        legacy_messages += [
+            {"type": "display_name", "display_name": snapshot["display_name"]},
+            {"type": "privacy", "privacy": snapshot["privacy"]},
+            {"type": "join_requests", "join_requests": snapshot["join_requests"]},
+            {
+                "type": "upload_url",
+                "upload_url": upload_url,
+                "refresh_upload_destination_in": SIGNED_URL_REFRESH_IN,
+            },
+            {
+                "type": "message_notifications",
+                "message_notifications": message_notifications,
+                "next_cursor": snapshot["next_cursor"],
+                "refresh_message_notifications_in": SIGNED_URL_REFRESH_IN,
+            },
+        ]
+        for message in legacy_messages:
+            await self.send_to_self(message)
+
+    async def send_room_snapshot(self, snapshot, message_notifications, upload_url):
+        await self.send_to_self(
+            {
+                "type": "room_snapshot",
+                "allowed": True,
+                "room": self.room_id,
+                "sequence": snapshot["sequence"],
+                "members": snapshot["members"],
+                "member_usernames": snapshot["member_usernames"],
+                "display_name": snapshot["display_name"],
+                "privacy": snapshot["privacy"],
+                "join_requests": snapshot["join_requests"],
+                "upload_url": upload_url,
+                "refresh_upload_destination_in": SIGNED_URL_REFRESH_IN,
+                "message_notifications": message_notifications,
+                "next_cursor": snapshot["next_cursor"],
+                "refresh_message_notifications_in": SIGNED_URL_REFRESH_IN,
+            }
+        )
+
+    async def resync(self):
+        snapshot = await database_sync_to_async(self.get_resync_snapshot)()
+        if not snapshot["allowed"]:
+            await self.send_to_self(
+                {"type": "room_snapshot", "allowed": False, "room": self.room_id}
+            )
+            return
+        message_notifications = await self.sign_message_notifications(
+            snapshot["message_notifications"]
+        )
+        upload_url = None
+        if snapshot["upload_blob"] is not None:
+            upload_url = await generate_upload_signed_url_v4_async(
+                str(snapshot["upload_blob"])
+            )
+        await self.send_room_snapshot(snapshot, message_notifications, upload_url)
+
+    async def send_deltas(self, deltas):
+        for delta in deltas:
+            if delta["facet"] in ROOM_METADATA_FACETS:
+                await room_cache.invalidate(delta["room"], delta["sequence"])
+            await self.channel_layer.group_send(delta["room"], delta)
 
     async def disconnect(self, close_code):
         await self.channel_layer.group_discard(str(self.room_id), self.channel_name)
@@ -240,82 +496,110 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
     async def receive_json(self, content, **kwargs):
         if content.get("command") == "connect":
             self.room_id = content.get("room")
+            self.snapshot_protocol = bool(content.get("snapshot"))
+            self.room_refresh_protocol = bool(content.get("room_refresh"))
+            self.delta_protocol = bool(content.get("deltas"))
+            self.paging_protocol = bool(content.get("paging"))
+            self.allowed_status = None
             await self.initialize_room()
         if content.get("command") == "disconnect":
             await self.channel_layer.group_discard(str(self.room_id), self.channel_name)
-        user_not_allowed = await database_sync_to_async(self.user_not_allowed)()
-        user_allowed = not user_not_allowed
+        user_allowed = await self.is_allowed()
         if content.get("command") == "fetch_allowed_status":
-            asyncio.create_task(self.fetch_allowed_status(user_allowed))
+            await self.schedule(content, self.fetch_allowed_status(user_allowed))
         elif user_allowed:
             if content.get("command") == "update_privacy":
-                asyncio.create_task(self.update_privacy(content))
+                await self.schedule(content, self.update_privacy(content))
             if content.get("command") == "fetch_privacy":
-                asyncio.create_task(self.fetch_privacy())
+                await self.schedule(content, self.fetch_privacy())
             if content.get("command") == "fetch_join_requests":
-                asyncio.create_task(self.fetch_join_requests())
+                await self.schedule(content, self.fetch_join_requests())
             if content.get("command") == "fetch_members":
-                asyncio.create_task(self.fetch_members())
+                await self.schedule(content, self.fetch_members())
             if content.get("command") == "reject_user":
-                asyncio.create_task(self.reject_user(content))
+                await self.schedule(content, self.reject_user(content))
             if content.get("command") == "approve_user":
-                asyncio.create_task(self.approve_user(content))
+                await self.schedule(content, self.approve_user(content))
             if content.get("command") == "approve_all_users":
-                asyncio.create_task(self.approve_all_users())
+                await self.schedule(content, self.approve_all_users())
             if content.get("command") == "update_display_name":
-                asyncio.create_task(self.update_display_name(content))
+                await self.schedule(content, self.update_display_name(content))
             if content.get("command") == "fetch_display_name":
-                asyncio.create_task(self.fetch_display_name())
+                await self.schedule(content, self.fetch_display_name())
             if content.get("command") == "read_room_notification":
-                asyncio.create_task(self.read_room_notification())
+                await self.schedule(content, self.read_room_notification())
             if content.get("command") == "fetch_upload_url":
-                asyncio.create_task(self.fetch_upload_url())
+                await self.schedule(content, self.fetch_upload_url())
             if content.get("command") == "send_message":
-                asyncio.create_task(self.send_message())
+                await self.schedule(content, self.send_message())
             if content.get("command") == "fetch_message_notifications":
-                asyncio.create_task(self.fetch_message_notifications())
+                await self.schedule(content, self.fetch_message_notifications(content))
             if content.get("command") == "read_message_notification":
-                asyncio.create_task(self.read_message_notification(content))
+                await self.schedule(content, self.read_message_notification(content))
+            if content.get("command") == "resync":
+                await self.schedule(content, self.resync())
+
+    async def is_allowed(self):
+        # Cached per connection; the refresh_allowed_status, refresh_privacy
+        # and refresh_members events clear it. The room itself comes from the
+        # shared room cache.
+        if self.allowed_status is None:
+            room = await room_cache.get(self.room_id)
+            self.allowed_status = (
+                not room["private"] or str(self.user.id) in room["member_ids"]
+            )
+        return self.allowed_status
 
     async def read_message_notification(self, input_payload):
         await database_sync_to_async(self.read_unread_message_notification)(
-            input_payload["message_notification_id"]
+            input_payload.get("message_notification_id"),
+            input_payload.get("message_id"),
         )
         await self.fetch_message_notifications()
 
-    async def fetch_message_notifications(self):
-        message_notifications = await database_sync_to_async(
-            self.get_message_notifications
-        )()
-        await self.channel_layer.send(
-            self.channel_name,
+    async def fetch_message_notifications(self, input_payload=None):
+        input_payload = input_payload or {}
+        message_notifications, next_cursor = await self.load_message_notifications(
+            input_payload.get("cursor"), self.page_size(input_payload)
+        )
+        await self.sign_message_notifications(message_notifications)
+        await self.send_to_self(
             {
                 "type": "message_notifications",
                 "message_notifications": message_notifications,
-                "refresh_message_notifications_in": 604790000,
-            },
+                "cursor": input_payload.get("cursor"),
+                "next_cursor": next_cursor,
+                "refresh_message_notifications_in": SIGNED_URL_REFRESH_IN,
+            }
         )
 
+    async def load_message_notifications(self, cursor, page_size):
+        if not settings.ASYNC_DB_READS:
+            return await database_sync_to_async(self.get_message_notifications)(
+                cursor, page_size
+            )
+        notifications, next_cursor = await async_reads.message_notifications(
+            self.user.id, self.room_id, cursor, page_size
+        )
+        return list(map(serialize_message_notification, notifications)), next_cursor
+
     async def send_message(self):
-        await database_sync_to_async(self.create_user_notifications_for_new_message)()
-        await database_sync_to_async(
-            self.create_message_notifications_for_new_message
+        room_member_usernames, delta = await database_sync_to_async(
+            self.record_new_message
         )()
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_message_notifications"},
+        message_notification = delta["message_notification"]
+        urls = await generate_download_signed_urls_v4_async(
+            [message_notification["message__id"]]
         )
-        (
-            room_member_display_names,
+        message_notification["url"] = urls[message_notification["message__id"]]
+        await self.send_deltas([delta])
+        await group_send_many(
+            self.channel_layer,
             room_member_usernames,
-        ) = await database_sync_to_async(self.get_all_room_members)()
-        for username in room_member_usernames:
-            await self.channel_layer.group_send(
-                username,
-                {
-                    "type": "refresh_notifications",
-                },
-            )
+            {
+                "type": "refresh_notifications",
+            },
+        )
         await self.channel_layer.group_send(
             self.room_id,
             {"type": "room_notified"},
@@ -324,14 +608,13 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
     async def fetch_upload_url(self):
         message = await database_sync_to_async(self.get_message)()
         filename = str(message.id)
-        url = generate_upload_signed_url_v4(filename)
-        await self.channel_layer.send(
-            self.channel_name,
+        url = await generate_upload_signed_url_v4_async(filename)
+        await self.send_to_self(
             {
                 "type": "upload_url",
                 "upload_url": url,
-                "refresh_upload_destination_in": 604790000,
-            },
+                "refresh_upload_destination_in": SIGNED_URL_REFRESH_IN,
+            }
         )
 
     async def read_room_notification(self):
@@ -345,165 +628,92 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
 
     async def update_display_name(self, input_payload):
         if len(input_payload["name"].strip()) > 0:
-            display_name, users_to_refresh = await database_sync_to_async(
+            display_name, users_to_refresh, delta = await database_sync_to_async(
                 self.change_display_name
             )(input_payload["name"])
-            for username in users_to_refresh:
-                await self.channel_layer.group_send(
-                    username, {"type": "refresh_notifications"}
-                )
-            await self.channel_layer.group_send(
-                self.room_id,
-                {
-                    "type": "display_name",
-                    "display_name": display_name,
-                },
+            await group_send_many(
+                self.channel_layer, users_to_refresh, {"type": "refresh_notifications"}
             )
+            await self.send_deltas([delta])
         else:
             await self.fetch_display_name()
 
     async def fetch_display_name(self):
-        room = await database_sync_to_async(self.get_room)(self.room_id)
-        display_name = room.display_name
-        await self.channel_layer.send(
-            self.channel_name,
-            {"type": "display_name", "display_name": display_name},
-        )
+        room = await room_cache.get(self.room_id)
+        display_name = room["display_name"]
+        await self.send_to_self({"type": "display_name", "display_name": display_name})
 
     async def approve_all_users(self):
-        added_usernames = await database_sync_to_async(self.approve_all_room_members)()
-        for username in added_usernames:
-            await self.channel_layer.group_send(
-                username,
-                {
-                    "type": "refresh_notifications",
-                },
-            )
-            await self.channel_layer.group_send(
-                self.room_id,
-                {"type": "refresh_display_name", "username": username},
-            )
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_join_requests"},
-        )
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_members"},
-        )
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_allowed_status"},
-        )
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_privacy"},
-        )
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_upload_url"},
-        )
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "room_notified"},
+        added_usernames, deltas = await database_sync_to_async(
+            self.approve_all_room_members
+        )()
+        await self.send_deltas(deltas)
+        await group_send_many(
+            self.channel_layer,
+            added_usernames,
+            {
+                "type": "refresh_notifications",
+            },
         )
+        room_refresher.mark(self.room_id, ["display_name"], added_usernames)
+        room_refresher.mark(self.room_id, APPROVAL_FACETS)
 
     async def fetch_allowed_status(self, allowed_status):
-        await self.channel_layer.send(
-            self.channel_name,
-            {"type": "allowed", "allowed": allowed_status, "room": self.room_id},
+        await self.send_to_self(
+            {"type": "allowed", "allowed": allowed_status, "room": self.room_id}
         )
         if not allowed_status:
-            await database_sync_to_async(self.get_or_create_new_join_request)()
-            await self.channel_layer.group_send(
-                self.room_id,
-                {"type": "refresh_join_requests"},
-            )
+            deltas = await database_sync_to_async(self.get_or_create_new_join_request)()
+            await self.send_deltas(deltas)
 
     async def approve_user(self, input_payload):
-        await database_sync_to_async(self.approve_room_member)(
+        deltas = await database_sync_to_async(self.approve_room_member)(
             input_payload["username"]
         )
+        await self.send_deltas(deltas)
         await self.channel_layer.group_send(
             input_payload["username"],
             {
                 "type": "refresh_notifications",
             },
         )
-
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_display_name", "username": input_payload["username"]},
-        )
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_join_requests"},
-        )
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_members"},
-        )
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_allowed_status"},
-        )
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_privacy"},
-        )
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_upload_url"},
-        )
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "room_notified"},
-        )
+        room_refresher.mark(self.room_id, ["display_name"], [input_payload["username"]])
+        room_refresher.mark(self.room_id, APPROVAL_FACETS)
 
     async def reject_user(self, input_payload):
-        await database_sync_to_async(self.reject_room_member)(input_payload["username"])
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_join_requests"},
+        delta = await database_sync_to_async(self.reject_room_member)(
+            input_payload["username"]
         )
+        await self.send_deltas([delta])
 
     async def fetch_members(self):
-        member_display_names, member_usernames = await database_sync_to_async(
-            self.get_all_room_members
-        )()
-        await self.channel_layer.send(
-            self.channel_name,
-            {"type": "members", "members": member_display_names},
-        )
-        room = await database_sync_to_async(self.get_room)(self.room_id)
-        if self.user.username not in member_usernames and not room.private:
-            await self.channel_layer.send(
-                self.channel_name,
-                {"type": "left_room", "room": str(room.id)},
-            )
+        room = await room_cache.get(self.room_id)
+        await self.send_to_self({"type": "members", "members": room["members"]})
+        if self.user.username not in room["member_usernames"] and not room["private"]:
+            await self.send_to_self({"type": "left_room", "room": room["id"]})
 
     async def fetch_privacy(self):
-        room = await database_sync_to_async(self.get_room)(self.room_id)
-        await self.channel_layer.send(
-            self.channel_name,
-            {"type": "privacy", "privacy": room.private},
-        )
+        room = await room_cache.get(self.room_id)
+        await self.send_to_self({"type": "privacy", "privacy": room["private"]})
 
     async def fetch_join_requests(self):
-        all_join_requests = await database_sync_to_async(self.get_all_join_requests)()
+        if settings.ASYNC_DB_READS:
+            all_join_requests = await async_reads.join_requests(self.room_id)
+        else:
+            all_join_requests = await database_sync_to_async(
+                self.get_all_join_requests
+            )()
         for request in all_join_requests:
             request["user"] = str(request["user"])
-        await self.channel_layer.send(
-            self.channel_name,
-            {"type": "join_requests", "join_requests": all_join_requests},
+        await self.send_to_self(
+            {"type": "join_requests", "join_requests": all_join_requests}
         )
 
     async def update_privacy(self, input_payload):
-        await database_sync_to_async(self.set_room_privacy)(input_payload["privacy"])
-        await self.channel_layer.group_send(
-            self.room_id,
-            {"type": "refresh_privacy"},
+        delta = await database_sync_to_async(self.set_room_privacy)(
+            input_payload["privacy"]
         )
+        await self.send_deltas([delta])
 
     async def refresh_display_name(self, event):
         if event.get("username"):
@@ -514,6 +724,78 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         else:
             await self.send_json(event)
 
+    async def room_delta(self, event):
+        if event["facet"] in ROOM_METADATA_FACETS:
+            room_cache.forget(event["room"], event["sequence"])
+        if event["facet"] == "members":
+            if self.user.username in event["member_usernames"]:
+                self.allowed_status = True
+            else:
+                self.allowed_status = None
+        if event["facet"] == "privacy":
+            self.allowed_status = True if not event["privacy"] else None
+        if not self.delta_protocol:
+            if event["facet"] == "display_name":
+                await self.send_json(
+                    {"type": "display_name", "display_name": event["display_name"]}
+                )
+            else:
+                await self.send_json({"type": LEGACY_DELTA_EVENTS[event["facet"]]})
+            return
+        delta = {
+            "type": "room_delta",
+            "room": event["room"],
+            "sequence": event["sequence"],
+            "facet": event["facet"],
+        }
+        # Sockets waiting on a join request only learn that something changed.
+        if await self.is_allowed():
+            if event["facet"] == "message_notification":
+                delta["message_notification"] = await self.own_message_notification(
+                    event
+                )
+            else:
+                delta.update(
+                    (key, value)
+                    for key, value in event.items()
+                    if key not in ("type", "room", "sequence", "facet")
+                )
+        await self.send_json(delta)
+
+    async def own_message_notification(self, event):
+        # Only members got a notification. It has no id here; clients read it
+        # with the message id.
+        room = await room_cache.get(self.room_id)
+        if str(self.user.id) not in room["member_ids"]:
+            return None
+        return dict(
+            event["message_notification"],
+            read=event["sender"] == self.user.username,
+        )
+
+    async def room_refresh(self, event):
+        facets = [
+            facet
+            for facet, usernames in event["facets"].items()
+            if usernames is None or self.user.username in usernames
+        ]
+        if "members" in event["facets"]:
+            room_cache.forget(self.room_id)
+        if {"allowed_status", "privacy", "members"}.intersection(facets):
+            self.allowed_status = None
+        if not facets:
+            return
+        if self.room_refresh_protocol:
+            await self.send_json({"type": "room_refresh", "facets": facets})
+            return
+        # Older clients get one legacy refresh event per facet.
+        for facet, event_type in ROOM_REFRESH_EVENTS.items():
+            if facet in facets:
+                legacy_event = {"type": event_type}
+                if event["facets"][facet] is not None:
+                    legacy_event["username"] = self.user.username
+                await self.send_json(legacy_event)
+
     async def refresh_message_notifications(self, event):
         # Send message to WebSocket
         await self.send_json(event)
@@ -535,6 +817,7 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         await self.send_json(event)
 
     async def refresh_allowed_status(self, event):
+        self.allowed_status = None
         # Send message to WebSocket
         await self.send_json(event)
 
@@ -543,6 +826,8 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         await self.send_json(event)
 
     async def refresh_members(self, event):
+        room_cache.forget(self.room_id)
+        self.allowed_status = None
         # Send message to WebSocket
         await self.send_json(event)
 
@@ -555,6 +840,7 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         await self.send_json(event)
 
     async def refresh_privacy(self, event):
+        self.allowed_status = None
         # Send message to WebSocket
         await self.send_json(event)
 
@@ -574,41 +860,67 @@ class RoomConsumer(AsyncJsonWebsocketConsumer):
         # Send message to WebSocket
         await self.send_json(event)
 
+    async def room_snapshot(self, event):
+        # Send message to WebSocket
+        await self.send_json(event)
 
-class UserConsumer(AsyncJsonWebsocketConsumer):
-    def get_user_notifications(self):
-        notifications = list(
-            self.user.usernotification_set.values(
-                "room",
-                "room__display_name",
-                "read",
-                "timestamp",
-                "message__creator__display_name",
-            )
-            .order_by("room", "-timestamp")
-            .distinct("room")
+
+class UserConsumer(
+    ScheduledConsumer,
+    PagedConsumer,
+    DirectDispatchConsumer,
+    InstrumentedConsumer,
+    AsyncJsonWebsocketConsumer,
+):
+    metrics_name = "user"
+    commands = frozenset(["exit_room", "fetch_notifications", "update_display_name"])
+    mutating_commands = frozenset(["exit_room", "update_display_name"])
+
+    def user_notifications_queryset(self):
+        return self.user.roominbox_set.values(
+            "id",
+            "room",
+            "room_display_name",
+            "read",
+            "last_activity",
+            "last_sender_name",
+            "unread_count",
         )
-        notifications.sort(key=itemgetter("timestamp"), reverse=True)
-        notifications.sort(key=itemgetter("read"))
-        for notification in notifications:
-            notification["room"] = str(notification["room"])
-            notification["timestamp"] = notification["timestamp"].strftime(
-                "%d-%m-%Y %H:%M:%S"
-            )
-        return notifications
+
+    def get_user_notifications(self, cursor=None, page_size=None):
+        notifications, next_cursor = paginate(
+            self.user_notifications_queryset(),
+            cursor,
+            page_size,
+            timestamp_field="last_activity",
+        )
+        return list(map(serialize_user_notification, notifications)), next_cursor
 
     def leave_room(self, room_id):
-        room_to_leave = Room.objects.get(id=room_id)
-        room_to_leave.members.remove(self.user)
-        self.user.room_set.remove(room_to_leave)
-        self.user.usernotification_set.filter(room=room_to_leave).delete()
-        self.user.messagenotification_set.filter(room=room_to_leave).delete()
-        if not room_to_leave.members.all() and not room_to_leave.joinrequest_set.all():
-            room_to_leave.delete()
+        with transaction.atomic():
+            room_to_leave = Room.objects.select_for_update().get(id=room_id)
+            room_to_leave.members.remove(self.user)
+            self.user.room_set.remove(room_to_leave)
+            self.user.usernotification_set.filter(room=room_to_leave).delete()
+            self.user.messagenotification_set.filter(room=room_to_leave).delete()
+            self.user.roominbox_set.filter(room=room_to_leave).delete()
+            if (
+                not room_to_leave.members.all()
+                and not room_to_leave.joinrequest_set.all()
+            ):
+                room_to_leave.delete()
+                return None
+            # The leaver's message no longer counts as unread for the others.
+            sync_room_inbox(room_to_leave.id)
+            return members_delta(room_to_leave.id)
 
     def change_display_name(self, new_name):
-        self.user.display_name = new_name
-        self.user.save()
+        with transaction.atomic():
+            self.user.display_name = new_name
+            self.user.save()
+            RoomInbox.objects.filter(last_sender=self.user).update(
+                last_sender_name=new_name
+            )
         rooms_to_refresh = [
             str(room["id"]) for room in self.user.room_set.all().values()
         ] + [
@@ -616,27 +928,25 @@ class UserConsumer(AsyncJsonWebsocketConsumer):
             for request in self.user.joinrequest_set.all().values()
         ]
         rooms_to_refresh = set(rooms_to_refresh)
-        users_to_refresh = [
-            str(notification["user__username"])
-            for notification in UserNotification.objects.all().values("user__username")
-        ]
+        users_to_refresh = list(
+            User.objects.filter(room__members=self.user)
+            .values_list("username", flat=True)
+            .distinct()
+        )
         return new_name, rooms_to_refresh, users_to_refresh
 
     async def connect(self):
         self.username = str(self.scope["url_route"]["kwargs"]["user_id"])
         self.user = self.scope["user"]
+        # The user socket sends notifications as soon as it connects, so
+        # paging is asked for in the URL rather than with a command.
+        query = parse_qs(self.scope["query_string"].decode())
+        self.paging_protocol = query.get("paging", [""])[0] in ("1", "true")
         if self.username == self.user.username:
             await self.channel_layer.group_add(self.username, self.channel_name)
             await self.accept()
 
-            notifications = await database_sync_to_async(self.get_user_notifications)()
-            await self.channel_layer.group_send(
-                self.username,
-                {
-                    "type": "notifications",
-                    "notifications": notifications,
-                },
-            )
+            await self.fetch_notifications()
             await self.fetch_display_name()
         else:
             await self.close()
@@ -647,11 +957,11 @@ class UserConsumer(AsyncJsonWebsocketConsumer):
     async def receive_json(self, content, **kwargs):
         if self.username == self.user.username:
             if content.get("command") == "exit_room":
-                asyncio.create_task(self.exit_room(content))
+                await self.schedule(content, self.exit_room(content))
             if content.get("command") == "fetch_notifications":
-                asyncio.create_task(self.fetch_notifications())
+                await self.schedule(content, self.fetch_notifications(content))
             if content.get("command") == "update_display_name":
-                asyncio.create_task(self.update_display_name(content))
+                await self.schedule(content, self.update_display_name(content))
 
     async def update_display_name(self, input_payload):
         if len(input_payload["name"].strip()) > 0:
@@ -663,21 +973,17 @@ class UserConsumer(AsyncJsonWebsocketConsumer):
                 input_payload["name"]
             )
             for room in rooms_to_refresh:
-                await self.channel_layer.group_send(room, {"type": "refresh_members"})
-                await self.channel_layer.group_send(
-                    room, {"type": "refresh_join_requests"}
-                )
-                await self.channel_layer.group_send(
-                    room,
-                    {"type": "refresh_message_notifications"},
-                )
-            for username in users_to_refresh:
-                await self.channel_layer.group_send(
-                    username,
-                    {
-                        "type": "refresh_notifications",
-                    },
+                await room_cache.invalidate(room)
+                room_refresher.mark(
+                    room, ["members", "join_requests", "message_notifications"]
                 )
+            await group_send_many(
+                self.channel_layer,
+                users_to_refresh,
+                {
+                    "type": "refresh_notifications",
+                },
+            )
             await self.channel_layer.group_send(
                 self.username,
                 {
@@ -690,27 +996,53 @@ class UserConsumer(AsyncJsonWebsocketConsumer):
 
     async def fetch_display_name(self):
         display_name = self.user.display_name
-        await self.channel_layer.send(
-            self.channel_name,
-            {"type": "display_name", "display_name": display_name},
+        await self.send_to_self({"type": "display_name", "display_name": display_name})
+
+    async def fetch_notifications(self, input_payload=None):
+        input_payload = input_payload or {}
+        cursor = input_payload.get("cursor")
+        page_size = self.page_size(input_payload)
+        notifications, next_cursor = await self.load_user_notifications(
+            cursor, page_size
         )
+        message = {
+            "type": "notifications",
+            "notifications": notifications,
+            "cursor": cursor,
+            "next_cursor": next_cursor,
+        }
+        if cursor:
+            # Later pages only concern the tab that asked for them.
+            await self.send_to_self(message)
+        else:
+            # Every tab gets the new first page; see notifications().
+            await self.channel_layer.group_send(
+                self.username,
+                {**message, "page_size": page_size, "requested_by": self.channel_name},
+            )
 
-    async def fetch_notifications(self):
-        notifications = await database_sync_to_async(self.get_user_notifications)()
-        await self.channel_layer.group_send(
-            self.username,
-            {
-                "type": "notifications",
-                "notifications": notifications,
-            },
+    async def load_user_notifications(self, cursor, page_size):
+        if not settings.ASYNC_DB_READS:
+            return await database_sync_to_async(self.get_user_notifications)(
+                cursor, page_size
+            )
+        notifications, next_cursor = await async_reads.user_notifications(
+            self.user.id, cursor, page_size
         )
+        return list(map(serialize_user_notification, notifications)), next_cursor
 
     async def exit_room(self, input_payload):
-        await database_sync_to_async(self.leave_room)(input_payload["room_id"])
-        await self.channel_layer.group_send(
-            input_payload["room_id"],
-            {"type": "refresh_members"},
+        delta = await database_sync_to_async(self.leave_room)(input_payload["room_id"])
+        await room_cache.invalidate(
+            input_payload["room_id"], delta["sequence"] if delta else None
         )
+        if delta is None:
+            await self.channel_layer.group_send(
+                input_payload["room_id"],
+                {"type": "refresh_members"},
+            )
+        else:
+            await self.channel_layer.group_send(input_payload["room_id"], delta)
         await self.channel_layer.group_send(
             input_payload["room_id"],
             {"type": "refresh_allowed_status"},
@@ -719,17 +1051,19 @@ class UserConsumer(AsyncJsonWebsocketConsumer):
             input_payload["room_id"],
             {"type": "refresh_message_notifications"},
         )
-        notifications = await database_sync_to_async(self.get_user_notifications)()
-        await self.channel_layer.group_send(
-            self.username,
-            {
-                "type": "notifications",
-                "notifications": notifications,
-            },
-        )
+        await self.fetch_notifications()
 
     async def notifications(self, event):
-        # Send message to WebSocket
+        event = dict(event)
+        page_size = event.pop("page_size", None)
+        requested_by = event.pop("requested_by", None)
+        # A first page sized for another tab is reloaded at this socket's own
+        # size, so tabs that do not page still get the whole list.
+        if requested_by != self.channel_name and page_size != self.page_size({}):
+            (
+                event["notifications"],
+                event["next_cursor"],
+            ) = await self.load_user_notifications(None, self.page_size({}))
         await self.send_json(event)
 
     async def refresh_notifications(self, event):
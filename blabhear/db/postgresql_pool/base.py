@@ -0,0 +1,64 @@
+import threading
+
+import psycopg2.extras
+from django.db.backends.postgresql import base
+from psycopg2.pool import ThreadedConnectionPool
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+class ConnectionPool(ThreadedConnectionPool):
+    def __init__(self, minconn, maxconn, **conn_params):
+        super().__init__(minconn, maxconn, **conn_params)
+        # ThreadedConnectionPool raises once maxconn are out; wait instead.
+        self.slots = threading.BoundedSemaphore(maxconn)
+
+
+def connection_pool(alias, settings_dict, conn_params):
+    with pools_lock:
+        if alias not in pools:
+            pools[alias] = ConnectionPool(
+                settings_dict.get("POOL_MIN_IDLE", 1),
+                settings_dict.get("POOL_MAX_CONNECTIONS", 10),
+                **conn_params,
+            )
+        return pools[alias]
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    PostgreSQL backend that borrows connections from a per-process pool and
+    hands them back on close(), so use it with CONN_MAX_AGE = 0.
+    """
+
+    def get_new_connection(self, conn_params):
+        pool = connection_pool(self.alias, self.settings_dict, conn_params)
+        pool.slots.acquire()
+        try:
+            connection = pool.getconn()
+        except Exception:
+            pool.slots.release()
+            raise
+        # The same per-connection setup as the stock backend.
+        options = self.settings_dict["OPTIONS"]
+        try:
+            self.isolation_level = options["isolation_level"]
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+        psycopg2.extras.register_default_jsonb(
+            conn_or_curs=connection, loads=lambda x: x
+        )
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            pool = pools[self.alias]
+            try:
+                with self.wrap_database_errors:
+                    pool.putconn(self.connection, close=bool(self.connection.closed))
+            finally:
+                pool.slots.release()
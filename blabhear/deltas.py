@@ -0,0 +1,53 @@
+from django.db.models import F
+
+from blabhear.models import JoinRequest, Room
+
+# Legacy invalidation sent to clients that did not negotiate deltas.
+LEGACY_DELTA_EVENTS = {
+    "members": "refresh_members",
+    "join_requests": "refresh_join_requests",
+    "privacy": "refresh_privacy",
+    "message_notification": "refresh_message_notifications",
+}
+
+
+def room_delta(room_id, facet, **state):
+    # Must run inside the transaction that made the change, so the row lock
+    # orders sequence numbers the same way as the commits.
+    Room.objects.filter(id=room_id).update(sequence=F("sequence") + 1)
+    sequence = Room.objects.values_list("sequence", flat=True).get(id=room_id)
+    return {
+        "type": "room_delta",
+        "room": str(room_id),
+        "sequence": sequence,
+        "facet": facet,
+        **state,
+    }
+
+
+def members_delta(room_id):
+    members = list(
+        Room.members.through.objects.filter(room_id=room_id).values_list(
+            "user__username", "user__display_name"
+        )
+    )
+    return room_delta(
+        room_id,
+        "members",
+        members=[display_name for username, display_name in members],
+        member_usernames=[username for username, display_name in members],
+    )
+
+
+def join_requests_delta(room_id):
+    join_requests = [
+        {
+            "user": str(request["user"]),
+            "user__username": request["user__username"],
+            "user__display_name": request["user__display_name"],
+        }
+        for request in JoinRequest.objects.filter(room_id=room_id)
+        .order_by("-timestamp")
+        .values("user", "user__username", "user__display_name")
+    ]
+    return room_delta(room_id, "join_requests", join_requests=join_requests)
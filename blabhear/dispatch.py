@@ -0,0 +1,27 @@
+import asyncio
+
+from django.conf import settings
+
+
+class DirectDispatchConsumer:
+    """
+    Delivers messages a consumer addresses to its own channel straight to
+    its handler instead of round-tripping them through the channel layer.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The channel layer hands a consumer one message at a time; this keeps
+        # direct deliveries from interleaving with it.
+        self.event_lock = asyncio.Lock()
+
+    async def dispatch(self, message):
+        if message["type"].startswith("websocket."):
+            return await super().dispatch(message)
+        async with self.event_lock:
+            await super().dispatch(message)
+
+    async def send_to_self(self, message):
+        if not settings.DIRECT_SELF_DISPATCH:
+            return await self.channel_layer.send(self.channel_name, message)
+        await self.dispatch(message)
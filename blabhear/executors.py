@@ -0,0 +1,58 @@
+import contextvars
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync as ChannelsDatabaseSyncToAsync
+from django.conf import settings
+
+from blabhear.metrics import (
+    command_labels,
+    db_executor_run,
+    db_executor_wait,
+    log_db_executor_metrics,
+    registry,
+)
+
+# Each worker holds at most one database connection, so this also caps how
+# many connections a process opens.
+db_executor = ThreadPoolExecutor(
+    max_workers=settings.DB_EXECUTOR_WORKERS, thread_name_prefix="db"
+)
+
+submitted_at = contextvars.ContextVar("submitted_at")
+
+
+class DatabaseSyncToAsync(ChannelsDatabaseSyncToAsync):
+    """
+    Runs ORM calls on the bounded db_executor instead of asgiref's single
+    thread-sensitive thread, timing queue wait and run time separately.
+    """
+
+    def __init__(self, func):
+        super().__init__(func, thread_sensitive=False, executor=db_executor)
+        self.func = functools.partial(self.timed, func)
+
+    async def __call__(self, *args, **kwargs):
+        submitted_at.set(time.monotonic())
+        return await super().__call__(*args, **kwargs)
+
+    @staticmethod
+    def timed(func, *args, **kwargs):
+        # Runs in the worker thread, inside a copy of the caller's context.
+        started = time.monotonic()
+        wait = started - submitted_at.get(started)
+        db_executor_wait.observe(wait)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            run = time.monotonic() - started
+            db_executor_run.observe(run)
+            if settings.METRICS_ENABLED:
+                labels = command_labels()
+                registry.observe("blabhear_db_executor_wait_seconds", labels, wait)
+                registry.observe("blabhear_db_executor_run_seconds", labels, run)
+            log_db_executor_metrics()
+
+
+database_sync_to_async = DatabaseSyncToAsync
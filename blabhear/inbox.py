@@ -0,0 +1,52 @@
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from blabhear.models import MessageNotification, Room, RoomInbox, UserNotification
+
+
+def unread_counts(room_id):
+    # Mirrors RoomConsumer.message_notifications_queryset: only messages from
+    # current members are listed, so only those count as unread.
+    return (
+        MessageNotification.objects.filter(
+            room_id=room_id,
+            receiver_id=OuterRef("user_id"),
+            read=False,
+            message__creator__room=room_id,
+        )
+        .order_by()
+        .values("receiver_id")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+
+
+def sync_room_inbox(room_id, user_ids=None):
+    # Must run inside the transaction that changed the notifications.
+    notifications = UserNotification.objects.filter(room_id=room_id)
+    inbox = RoomInbox.objects.filter(room_id=room_id)
+    if user_ids is not None:
+        notifications = notifications.filter(user_id__in=user_ids)
+        inbox = inbox.filter(user_id__in=user_ids)
+    RoomInbox.objects.bulk_create(
+        [
+            RoomInbox(user_id=user_id, room_id=room_id)
+            for user_id in notifications.values_list("user_id", flat=True)
+        ],
+        ignore_conflicts=True,
+    )
+    notification = UserNotification.objects.filter(
+        room_id=room_id, user_id=OuterRef("user_id")
+    )
+    inbox.update(
+        room_display_name=Subquery(
+            Room.objects.filter(id=room_id).values("display_name")
+        ),
+        last_sender=Subquery(notification.values("message__creator")),
+        last_sender_name=Subquery(
+            notification.values("message__creator__display_name")
+        ),
+        last_activity=Subquery(notification.values("timestamp")),
+        read=Subquery(notification.values("read")),
+        unread_count=Coalesce(Subquery(unread_counts(room_id)), 0),
+    )
@@ -0,0 +1,107 @@
+import time
+
+from django.conf import settings
+
+from blabhear.broadcast import group_send_many
+from blabhear.metrics import command_labels, current_command, registry
+
+
+class MeteredChannelLayer:
+    """
+    Wraps a consumer's channel layer to count what it sends, by command.
+    """
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+
+    def __getattr__(self, name):
+        return getattr(self.channel_layer, name)
+
+    async def send(self, channel, message):
+        registry.inc("blabhear_channel_layer_sends_total", command_labels(kind="send"))
+        await self.channel_layer.send(channel, message)
+
+    async def group_send(self, group, message):
+        registry.inc(
+            "blabhear_channel_layer_sends_total", command_labels(kind="group_send")
+        )
+        await self.channel_layer.group_send(group, message)
+
+    async def group_send_many(self, groups, message):
+        registry.inc(
+            "blabhear_channel_layer_sends_total",
+            command_labels(kind="group_send_many"),
+        )
+        await group_send_many(self.channel_layer, groups, message)
+
+
+class InstrumentedConsumer:
+    """
+    Labels everything a consumer does with the command or group event that
+    caused it. With METRICS_ENABLED off each hook is a single settings check.
+    """
+
+    metrics_name = None
+    # Commands the consumer handles. Anything else a client sends is labelled
+    # "unknown", so clients cannot add label values.
+    commands = frozenset()
+
+    async def websocket_connect(self, message):
+        if settings.METRICS_ENABLED and self.channel_layer is not None:
+            self.channel_layer = MeteredChannelLayer(self.channel_layer)
+        await super().websocket_connect(message)
+
+    async def dispatch(self, message):
+        if not settings.METRICS_ENABLED or message["type"].startswith("websocket."):
+            return await super().dispatch(message)
+        token = current_command.set(message["type"])
+        started = time.monotonic()
+        try:
+            await super().dispatch(message)
+        finally:
+            registry.observe(
+                "blabhear_event_seconds",
+                (("consumer", self.metrics_name), ("event", message["type"])),
+                time.monotonic() - started,
+            )
+            current_command.reset(token)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if not settings.METRICS_ENABLED or not text_data:
+            return await super().receive(text_data, bytes_data, **kwargs)
+        content = await self.decode_json(text_data)
+        command = content.get("command")
+        if not isinstance(command, str) or command not in self.commands:
+            command = "unknown"
+        token = current_command.set(command)
+        self.received_at = started = time.monotonic()
+        try:
+            await self.receive_json(content, **kwargs)
+        finally:
+            registry.observe(
+                "blabhear_receive_seconds",
+                command_labels(consumer=self.metrics_name),
+                time.monotonic() - started,
+            )
+            current_command.reset(token)
+
+    def track_command(self, task):
+        # Times a command task from the moment its frame was received.
+        if not settings.METRICS_ENABLED:
+            return
+        labels = command_labels(consumer=self.metrics_name)
+        received_at = self.received_at
+        task.add_done_callback(
+            lambda task: registry.observe(
+                "blabhear_command_seconds", labels, time.monotonic() - received_at
+            )
+        )
+
+    async def send_json(self, content, close=False):
+        if not settings.METRICS_ENABLED:
+            return await super().send_json(content, close)
+        text_data = await self.encode_json(content)
+        labels = command_labels(consumer=self.metrics_name)
+        registry.inc("blabhear_frames_total", labels)
+        registry.inc("blabhear_frame_bytes_total", labels, len(text_data.encode()))
+        await self.send(text_data=text_data, close=close)
@@ -0,0 +1,124 @@
+import collections
+import logging
+import time
+
+from cachetools import LRUCache
+from channels_redis import core, pubsub
+
+logger = logging.getLogger(__name__)
+
+# Same as channels_redis' group send script, with the expired message sweep
+# folded in so each shard takes a single round trip.
+GROUP_SEND_MANY_LUA = """
+    local over_capacity = 0
+    local current_time = ARGV[#ARGV - 2]
+    local expiry = ARGV[#ARGV - 1]
+    local oldest = ARGV[#ARGV]
+    for i=1,#KEYS do
+        redis.call('ZREMRANGEBYSCORE', KEYS[i], 0, oldest)
+        if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+            redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+
+
+class RedisChannelLayer(core.RedisChannelLayer):
+    """
+    channels_redis layer that can send one message to many groups at once.
+    """
+
+    async def group_send_many(self, groups, message):
+        """
+        Sends a message to every channel in any of the groups, once per
+        channel. Membership is read with one pipeline per shard and the
+        message is delivered with one script call per shard.
+        """
+        groups = list(dict.fromkeys(groups))
+        groups_by_shard = collections.defaultdict(list)
+        for group in groups:
+            assert self.valid_group_name(group), "Group name not valid"
+            groups_by_shard[self.consistent_hash(group)].append(group)
+
+        channel_names = {}
+        oldest_member = int(time.time()) - self.group_expiry
+        for index, shard_groups in groups_by_shard.items():
+            async with self.connection(index) as connection:
+                pipe = connection.pipeline()
+                for group in shard_groups:
+                    key = self._group_key(group)
+                    pipe.zremrangebyscore(key, min=0, max=oldest_member)
+                    pipe.zrange(key, 0, -1)
+                results = await pipe.execute()
+            for members in results[1::2]:
+                channel_names.update(dict.fromkeys(name.decode() for name in members))
+        if not channel_names:
+            return
+
+        (
+            connection_to_channel_keys,
+            channel_keys_to_message,
+            channel_keys_to_capacity,
+        ) = self._map_channel_keys_to_connection(list(channel_names), message)
+
+        now = time.time()
+        for index, channel_keys in connection_to_channel_keys.items():
+            args = [channel_keys_to_message[key] for key in channel_keys]
+            args += [channel_keys_to_capacity[key] for key in channel_keys]
+            args += [now, self.expiry, int(now) - int(self.expiry)]
+            async with self.connection(index) as connection:
+                over_capacity = await connection.eval(
+                    GROUP_SEND_MANY_LUA, keys=channel_keys, args=args
+                )
+            if over_capacity > 0:
+                logger.info(
+                    "%s of %s channels over capacity sending to %s groups",
+                    over_capacity,
+                    len(channel_names),
+                    len(groups),
+                )
+
+
+class RedisPubSubChannelLayer(pubsub.RedisPubSubChannelLayer):
+    """
+    channels_redis pub/sub layer: each process subscribes once per group and
+    hands every group message to the local channels in that group. The
+    upstream layer queues the raw bytes for each of those channels; this one
+    decodes them once for all of them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Keyed by id() and holding the bytes, so an id can't be reused while
+        # its entry is cached.
+        self.decoded = LRUCache(maxsize=1024)
+
+    def deserialize(self, message):
+        cached = self.decoded.get(id(message))
+        if cached is not None and cached[0] is message:
+            return cached[1]
+        decoded = super().deserialize(message)
+        self.decoded[id(message)] = (message, decoded)
+        return decoded
+
+    async def group_send_many(self, groups, message):
+        """
+        Publishes a message to each group, serialized once and pipelined per
+        shard.
+        """
+        layer = self._get_layer()
+        payload = self.serialize(message)
+        channels_by_shard = collections.defaultdict(list)
+        for group in dict.fromkeys(groups):
+            group_channel = layer._get_group_channel_name(group)
+            channels_by_shard[layer._get_shard(group_channel)].append(group_channel)
+        for shard, group_channels in channels_by_shard.items():
+            connection = await shard._get_pub_conn()
+            pipe = connection.pipeline()
+            for group_channel in group_channels:
+                pipe.publish(group_channel, payload)
+            await pipe.execute()
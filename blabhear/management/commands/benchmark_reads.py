@@ -0,0 +1,127 @@
+import asyncio
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from blabhear.consumers import RoomConsumer, UserConsumer
+from blabhear.executors import database_sync_to_async
+from blabhear.models import User
+from blabhear.reads import async_reads
+from blabhear.room_cache import load_room_metadata
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare p50/p99 latency of the hot consumer reads through the ORM "
+        "executor and through asyncpg."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=500)
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=20,
+            help="Reads in flight at once, as when many sockets refresh together.",
+        )
+        parser.add_argument("--username", help="Read as this user.")
+
+    def handle(self, *args, **options):
+        user = self.pick_user(options["username"])
+        room = user.room_set.annotate(size=Count("members")).order_by("-size").first()
+        if room is None:
+            raise CommandError(f"{user.username} is not a member of any room.")
+        room_consumer = RoomConsumer()
+        room_consumer.user = user
+        room_consumer.room_id = str(room.id)
+        user_consumer = UserConsumer()
+        user_consumer.user = user
+        page_size = 50
+
+        reads = [
+            (
+                "room metadata",
+                database_sync_to_async(lambda: load_room_metadata(room.id)),
+                lambda: async_reads.room_metadata(room.id),
+            ),
+            (
+                "join requests",
+                database_sync_to_async(room_consumer.get_all_join_requests),
+                lambda: async_reads.join_requests(room.id),
+            ),
+            (
+                "message notifications",
+                database_sync_to_async(
+                    lambda: room_consumer.get_message_notifications(None, page_size)
+                ),
+                lambda: async_reads.message_notifications(
+                    user.id, room.id, None, page_size
+                ),
+            ),
+            (
+                "user notifications",
+                database_sync_to_async(
+                    lambda: user_consumer.get_user_notifications(None, page_size)
+                ),
+                lambda: async_reads.user_notifications(user.id, None, page_size),
+            ),
+        ]
+        self.stdout.write(
+            f"Reading as {user.username} in room {room.id}, "
+            f"{options['iterations']} reads per path, "
+            f"{options['concurrency']} in flight"
+        )
+        self.stdout.write(
+            f"{'read':<24}{'path':<10}{'p50 ms':>10}{'p99 ms':>10}{'mean ms':>10}"
+        )
+        asyncio.run(self.benchmark(reads, options))
+
+    def pick_user(self, username):
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError(f"No user named {username!r}.")
+        user = (
+            User.objects.annotate(rooms=Count("room"))
+            .filter(rooms__gt=0)
+            .order_by("-rooms")
+            .first()
+        )
+        if user is None:
+            raise CommandError("There are no room members to read as.")
+        return user
+
+    async def benchmark(self, reads, options):
+        for label, orm_read, async_read in reads:
+            # Warm up connections, pools and prepared statements first.
+            await orm_read()
+            await async_read()
+            for path, read in (("orm", orm_read), ("asyncpg", async_read)):
+                samples = await self.measure(read, options)
+                self.stdout.write(
+                    f"{label:<24}{path:<10}"
+                    f"{percentile(samples, 0.5) * 1000:>10.2f}"
+                    f"{percentile(samples, 0.99) * 1000:>10.2f}"
+                    f"{statistics.mean(samples) * 1000:>10.2f}"
+                )
+
+    async def measure(self, read, options):
+        samples = []
+        remaining = iter(range(options["iterations"]))
+
+        async def worker():
+            for _ in remaining:
+                started = time.perf_counter()
+                await read()
+                samples.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(worker() for _ in range(options["concurrency"])))
+        return samples
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from blabhear.management.commands.loadtest import (
+    percentile,
+    prepare_environment,
+    stub_verify_token,
+)
+
+COMMANDS = [
+    ("fetch_privacy", "privacy"),
+    ("fetch_display_name", "display_name"),
+    ("fetch_members", "members"),
+    ("fetch_join_requests", "join_requests"),
+    ("fetch_upload_url", "upload_url"),
+    ("fetch_message_notifications", "message_notifications"),
+]
+
+
+class Socket:
+    def __init__(self, application, path, timeout):
+        from channels.testing import WebsocketCommunicator
+
+        self.communicator = WebsocketCommunicator(application, path)
+        self.timeout = timeout
+
+    async def request(self, payload, reply_type):
+        await self.communicator.send_json_to(payload)
+        while True:
+            # Read the queue directly: receive_json_from cancels the consumer
+            # when it times out.
+            message = await asyncio.wait_for(
+                self.communicator.output_queue.get(), self.timeout
+            )
+            frame = json.loads(message["text"])
+            if frame["type"] == reply_type:
+                return message["text"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare replies a consumer sends to itself through the channel layer "
+        "with direct dispatch: round trip per command and, with a Redis "
+        "layer, Redis commands per command."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=200)
+        parser.add_argument(
+            "--messages",
+            type=int,
+            default=50,
+            help="Messages to seed, which sizes the notification payload.",
+        )
+        parser.add_argument(
+            "--layer",
+            choices=["memory", "configured"],
+            default="configured",
+            help="memory uses InMemoryChannelLayer; configured uses CHANNEL_LAYERS.",
+        )
+        parser.add_argument("--timeout", type=float, default=10)
+
+    def handle(self, *args, **options):
+        prepare_environment(options["layer"])
+        username = f"benchmark-{uuid.uuid4().hex[:8]}"
+        room_id = str(uuid.uuid4())
+        direct_self_dispatch = settings.DIRECT_SELF_DISPATCH
+        try:
+            results = asyncio.run(self.run(username, room_id, options))
+        finally:
+            settings.DIRECT_SELF_DISPATCH = direct_self_dispatch
+            self.clean_up(username, room_id)
+        self.report(results)
+
+    async def run(self, username, room_id, options):
+        from blabhear import routing
+        from blabhear.authentication import TokenAuthMiddlewareStack
+        from blabhear.room_cache import redis_address
+        from channels.routing import URLRouter
+
+        application = TokenAuthMiddlewareStack(
+            URLRouter(routing.websocket_urlpatterns), verify_token=stub_verify_token
+        )
+        redis = None
+        if options["layer"] == "configured" and redis_address():
+            import aioredis
+
+            redis = await aioredis.create_redis_pool(redis_address())
+        socket = Socket(application, f"/ws/room/?token={username}", options["timeout"])
+        await socket.communicator.connect(timeout=options["timeout"])
+        try:
+            await socket.request(
+                {"command": "connect", "room": room_id, "snapshot": True},
+                "room_snapshot",
+            )
+            for message in range(options["messages"]):
+                await socket.request(
+                    {"command": "send_message"}, "refresh_message_notifications"
+                )
+            results = {}
+            for direct in (False, True):
+                settings.DIRECT_SELF_DISPATCH = direct
+                for command, reply_type in COMMANDS:
+                    results[command, direct] = await self.measure(
+                        socket, redis, command, reply_type, options["iterations"]
+                    )
+            return results
+        finally:
+            await socket.communicator.disconnect()
+            if redis is not None:
+                redis.close()
+                await redis.wait_closed()
+
+    async def measure(self, socket, redis, command, reply_type, iterations):
+        # Warm the room cache and signed URL cache before timing.
+        reply = await socket.request({"command": command}, reply_type)
+        commands_before = await self.redis_commands(redis)
+        round_trips = []
+        for iteration in range(iterations):
+            started = time.perf_counter()
+            await socket.request({"command": command}, reply_type)
+            round_trips.append(time.perf_counter() - started)
+        commands_after = await self.redis_commands(redis)
+        redis_commands = None
+        if redis is not None:
+            # Less the INFO call that took the first reading.
+            redis_commands = (commands_after - commands_before - 1) / iterations
+        return round_trips, redis_commands, len(reply.encode())
+
+    async def redis_commands(self, redis):
+        if redis is None:
+            return None
+        info = await redis.info("stats")
+        return int(info["stats"]["total_commands_processed"])
+
+    def report(self, results):
+        self.stdout.write(
+            f"{'command':<30}{'bytes':>8}{'via':>8}{'p50 ms':>9}{'p99 ms':>9}"
+            f"{'redis ops':>11}"
+        )
+        for command, reply_type in COMMANDS:
+            for direct in (False, True):
+                round_trips, redis_commands, size = results[command, direct]
+                self.stdout.write(
+                    f"{command if not direct else '':<30}"
+                    f"{size if not direct else '':>8}"
+                    f"{'direct' if direct else 'layer':>8}"
+                    f"{percentile(round_trips, 0.5) * 1000:>9.2f}"
+                    f"{percentile(round_trips, 0.99) * 1000:>9.2f}"
+                    f"{'n/a' if redis_commands is None else f'{redis_commands:.1f}':>11}"
+                )
+        if results[COMMANDS[0][0], False][1] is None:
+            self.stdout.write(
+                "Redis ops are only counted with a Redis channel layer "
+                "(--layer configured)."
+            )
+
+    def clean_up(self, username, room_id):
+        from blabhear.models import Room, User
+
+        Room.objects.filter(id=room_id).delete()
+        User.objects.filter(username=username).delete()
@@ -0,0 +1,117 @@
+import random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+
+from blabhear.consumers import RoomConsumer, UserConsumer
+from blabhear.models import JoinRequest, Room, User
+from blabhear.pagination import page_queryset
+
+
+class Command(BaseCommand):
+    help = "Print EXPLAIN ANALYZE for the hot notification and membership reads."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--seed",
+            action="store_true",
+            help="Seed synthetic users, rooms and messages first and roll them back afterwards.",
+        )
+        parser.add_argument("--users", type=int, default=500)
+        parser.add_argument("--rooms", type=int, default=100)
+        parser.add_argument("--members", type=int, default=20)
+        parser.add_argument("--join-requests", type=int, default=5)
+        parser.add_argument("--username", help="Explain the reads for this user.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options["seed"]:
+                self.seed(options)
+            self.explain(self.pick_user(options["username"]))
+            if options["seed"]:
+                transaction.set_rollback(True)
+
+    def seed(self, options):
+        users = [
+            User(username=f"explain-{index}", display_name=f"Explain {index}")
+            for index in range(options["users"])
+        ]
+        User.objects.bulk_create(users)
+        for index in range(options["rooms"]):
+            room = Room.objects.create(display_name=f"Explain room {index}")
+            sample = random.sample(
+                users, min(len(users), options["members"] + options["join_requests"])
+            )
+            members = sample[: options["members"]]
+            room.members.add(*members)
+            JoinRequest.objects.bulk_create(
+                JoinRequest(user=user, room=room)
+                for user in sample[options["members"] :]
+            )
+            # Record through the consumer so the rows look like production.
+            consumer = RoomConsumer()
+            consumer.room_id = room.id
+            for member in members:
+                consumer.user = member
+                consumer.record_new_message()
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def pick_user(self, username):
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError(f"No user named {username!r}.")
+        user = (
+            User.objects.annotate(notifications=Count("messagenotification"))
+            .order_by("-notifications")
+            .first()
+        )
+        if user is None:
+            raise CommandError("The database is empty; run with --seed.")
+        return user
+
+    def explain(self, user):
+        room = (
+            user.room_set.annotate(requests=Count("joinrequest"))
+            .order_by("-requests")
+            .first()
+        )
+        if room is None:
+            raise CommandError(f"{user.username} is not a member of any room.")
+        room_consumer = RoomConsumer()
+        room_consumer.user = user
+        room_consumer.room_id = room.id
+        user_consumer = UserConsumer()
+        user_consumer.user = user
+
+        hot_queries = [
+            (
+                "UserConsumer.get_user_notifications",
+                page_queryset(
+                    user_consumer.user_notifications_queryset(),
+                    None,
+                    settings.NOTIFICATION_PAGE_SIZE,
+                    timestamp_field="last_activity",
+                ),
+            ),
+            (
+                "RoomConsumer.get_message_notifications",
+                page_queryset(
+                    room_consumer.message_notifications_queryset(),
+                    None,
+                    settings.NOTIFICATION_PAGE_SIZE,
+                ),
+            ),
+            (
+                "RoomConsumer.get_all_join_requests",
+                room_consumer.join_requests_queryset(room),
+            ),
+        ]
+        self.stdout.write(f"Explaining as {user.username} in room {room.id}")
+        for label, queryset in hot_queries:
+            self.stdout.write(self.style.MIGRATE_HEADING(label))
+            self.stdout.write(queryset.explain(analyze=True, buffers=True))
@@ -0,0 +1,428 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.backends.signals import connection_created
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def stub_verify_token(token):
+    # The token is the uid, so every simulated user is trusted as is.
+    return {"uid": token}
+
+
+def prepare_environment(layer):
+    # Signed URLs are computed locally, so a throwaway key is enough to run
+    # without the Firebase service account.
+    if not os.environ.get("FIREBASE_PRIVATE_KEY"):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        os.environ["FIREBASE_PRIVATE_KEY"] = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ).decode()
+        os.environ.setdefault(
+            "FIREBASE_CLIENT_EMAIL", "loadtest@loadtest.iam.gserviceaccount.com"
+        )
+    os.environ.setdefault("GCP_UPLOAD_BUCKET", "loadtest")
+    if layer == "memory":
+        from channels.layers import channel_layers
+
+        settings.CHANNEL_LAYERS = {
+            "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+        }
+        channel_layers.backends = {}
+
+
+class QueryCounter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+
+class Phase:
+    def __init__(self, name):
+        self.name = name
+        self.round_trips = []
+        self.timeouts = 0
+        self.queries = 0
+        self.frames = Counter()
+
+
+class Client:
+    def __init__(self, loadtest, path):
+        from channels.testing import WebsocketCommunicator
+
+        self.loadtest = loadtest
+        self.communicator = WebsocketCommunicator(loadtest.application, path)
+        self.waiters = []
+        self.reader = None
+
+    async def connect(self):
+        started = time.perf_counter()
+        await self.communicator.connect(timeout=self.loadtest.timeout)
+        self.loadtest.connect_latencies.append(time.perf_counter() - started)
+        # Read straight off the queue: receive_output cancels the app when it
+        # times out.
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        while True:
+            message = await self.communicator.output_queue.get()
+            if message["type"] != "websocket.send":
+                return
+            frame = json.loads(message["text"])
+            self.loadtest.received(frame)
+            for waiter in list(self.waiters):
+                expected, future = waiter
+                if frame["type"] in expected and not future.done():
+                    future.set_result(frame)
+                    self.waiters.remove(waiter)
+                    break
+
+    async def command(self, payload, expected, phase):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((expected, future))
+        started = time.perf_counter()
+        await self.communicator.send_json_to(payload)
+        try:
+            await asyncio.wait_for(future, self.loadtest.timeout)
+        except asyncio.TimeoutError:
+            phase.timeouts += 1
+        else:
+            phase.round_trips.append(time.perf_counter() - started)
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        await self.communicator.disconnect()
+
+
+class LoadTest:
+    def __init__(self, command, options):
+        from blabhear import routing
+        from blabhear.authentication import TokenAuthMiddlewareStack
+        from channels.routing import URLRouter
+
+        self.stdout = command.stdout
+        self.style = command.style
+        self.options = options
+        self.timeout = options["timeout"]
+        self.application = TokenAuthMiddlewareStack(
+            URLRouter(routing.websocket_urlpatterns), verify_token=stub_verify_token
+        )
+        self.queries = QueryCounter()
+        self.connect_latencies = []
+        self.phases = []
+        self.phase = None
+        self.last_frame_at = time.monotonic()
+        run = uuid.uuid4().hex[:8]
+        self.usernames = [
+            f"loadtest-{run}-{index}" for index in range(options["users"])
+        ]
+        self.room_ids = [str(uuid.uuid4()) for index in range(options["rooms"])]
+        if options["protocol"] == "current":
+            self.flags = {
+                "snapshot": True,
+                "room_refresh": True,
+                "deltas": True,
+                "paging": True,
+            }
+            self.user_query = "&paging=1"
+        else:
+            self.flags = {}
+            self.user_query = ""
+
+    def received(self, frame):
+        self.last_frame_at = time.monotonic()
+        if self.phase is not None:
+            self.phase.frames[frame["type"]] += 1
+
+    def expect(self, current, legacy):
+        return {current if self.options["protocol"] == "current" else legacy}
+
+    async def run(self):
+        connection_created.connect(self.queries.install, weak=False)
+        rooms = {room_id: [] for room_id in self.room_ids}
+        for index, username in enumerate(self.usernames):
+            rooms[self.room_ids[index % len(self.room_ids)]].append(username)
+        self.user_sockets = {}
+        self.room_sockets = {}
+        try:
+            await self.connect_all()
+            await self.scenario(rooms)
+        finally:
+            for client in [*self.user_sockets.values(), *self.room_sockets.values()]:
+                await client.close()
+            connection_created.disconnect(self.queries.install)
+        self.report()
+
+    async def connect_all(self):
+        semaphore = asyncio.Semaphore(self.options["concurrency"])
+
+        async def connect(username):
+            async with semaphore:
+                user_socket = Client(
+                    self, f"/ws/user/{username}/?token={username}{self.user_query}"
+                )
+                await user_socket.connect()
+                room_socket = Client(self, f"/ws/room/?token={username}")
+                await room_socket.connect()
+                self.user_sockets[username] = user_socket
+                self.room_sockets[username] = room_socket
+
+        await asyncio.gather(*(connect(username) for username in self.usernames))
+        await self.settle()
+
+    async def scenario(self, rooms):
+        owners = {room_id: usernames[0] for room_id, usernames in rooms.items()}
+        members = {room_id: usernames[1:] for room_id, usernames in rooms.items()}
+        ready = self.expect("room_snapshot", "message_notifications")
+
+        await self.run_phase(
+            "connect (owner)",
+            {
+                room_id: [
+                    (
+                        self.room_sockets[owner],
+                        {"command": "connect", "room": room_id, **self.flags},
+                        ready,
+                    )
+                ]
+                for room_id, owner in owners.items()
+            },
+        )
+        await self.run_phase(
+            "update_privacy",
+            {
+                room_id: [
+                    (
+                        self.room_sockets[owner],
+                        {"command": "update_privacy", "privacy": True},
+                        self.expect("room_delta", "refresh_privacy"),
+                    )
+                ]
+                for room_id, owner in owners.items()
+            },
+        )
+        await self.run_phase(
+            "connect (join request)",
+            {
+                room_id: [
+                    (
+                        self.room_sockets[username],
+                        {"command": "connect", "room": room_id, **self.flags},
+                        self.expect("room_snapshot", "allowed"),
+                    )
+                    for username in usernames
+                ]
+                for room_id, usernames in members.items()
+            },
+        )
+        await self.run_phase(
+            "approve_user",
+            {
+                room_id: [
+                    (
+                        self.room_sockets[owners[room_id]],
+                        {"command": "approve_user", "username": username},
+                        self.expect("room_delta", "refresh_members"),
+                    )
+                    for username in usernames
+                ]
+                for room_id, usernames in members.items()
+            },
+        )
+        await self.run_phase(
+            "send_message",
+            {
+                room_id: [
+                    (
+                        self.room_sockets[username],
+                        {"command": "send_message"},
+                        self.expect("room_delta", "refresh_message_notifications"),
+                    )
+                    for message in range(self.options["messages"])
+                    for username in usernames
+                ]
+                for room_id, usernames in rooms.items()
+            },
+        )
+        await self.run_phase(
+            "fetch_message_notifications",
+            {
+                room_id: [
+                    (
+                        self.room_sockets[username],
+                        {"command": "fetch_message_notifications"},
+                        {"message_notifications"},
+                    )
+                    for username in usernames
+                ]
+                for room_id, usernames in rooms.items()
+            },
+        )
+        await self.run_phase(
+            "update_display_name",
+            {
+                room_id: [
+                    (
+                        self.user_sockets[username],
+                        {"command": "update_display_name", "name": f"{username}*"},
+                        {"display_name"},
+                    )
+                    for username in usernames
+                ]
+                for room_id, usernames in rooms.items()
+            },
+        )
+        await self.run_phase(
+            "exit_room",
+            {
+                room_id: [
+                    (
+                        self.user_sockets[username],
+                        {"command": "exit_room", "room_id": room_id},
+                        {"notifications"},
+                    )
+                    for username in usernames
+                ]
+                for room_id, usernames in members.items()
+            },
+        )
+
+    async def run_phase(self, name, jobs_by_room):
+        # Rooms run in parallel; commands within a room run one after another
+        # so each reply can be matched to the command that caused it.
+        phase = Phase(name)
+        self.phases.append(phase)
+        self.phase = phase
+        queries_before = self.queries.count
+        semaphore = asyncio.Semaphore(self.options["concurrency"])
+
+        async def run_room(jobs):
+            async with semaphore:
+                for client, payload, expected in jobs:
+                    await client.command(payload, expected, phase)
+
+        await asyncio.gather(*(run_room(jobs) for jobs in jobs_by_room.values()))
+        await self.settle()
+        phase.queries = self.queries.count - queries_before
+        self.phase = None
+
+    async def settle(self):
+        # Let the broadcasts a phase caused finish before measuring the next.
+        while time.monotonic() - self.last_frame_at < self.options["settle"]:
+            await asyncio.sleep(self.options["settle"] / 4)
+
+    def report(self):
+        self.stdout.write(
+            f"{len(self.usernames)} users in {len(self.room_ids)} rooms, "
+            f"{self.options['protocol']} protocol, "
+            f"{settings.CHANNEL_LAYERS['default']['BACKEND']}"
+        )
+        latencies = self.connect_latencies
+        self.stdout.write(
+            f"socket connect: p50 {percentile(latencies, 0.5) * 1000:.1f}ms "
+            f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms "
+            f"over {len(latencies)} sockets"
+        )
+        self.stdout.write(
+            f"{'command':<30}{'count':>7}{'p50 ms':>9}{'p90 ms':>9}"
+            f"{'p99 ms':>9}{'queries':>9}{'frames':>8}{'timeouts':>10}"
+        )
+        for phase in self.phases:
+            count = len(phase.round_trips) + phase.timeouts
+            samples = phase.round_trips or [0]
+            self.stdout.write(
+                f"{phase.name:<30}{count:>7}"
+                f"{percentile(samples, 0.5) * 1000:>9.1f}"
+                f"{percentile(samples, 0.9) * 1000:>9.1f}"
+                f"{percentile(samples, 0.99) * 1000:>9.1f}"
+                f"{phase.queries / max(count, 1):>9.1f}"
+                f"{sum(phase.frames.values()) / max(count, 1):>8.1f}"
+                f"{phase.timeouts:>10}"
+            )
+        self.stdout.write("Frames per command by type:")
+        for phase in self.phases:
+            count = len(phase.round_trips) + phase.timeouts
+            frames = ", ".join(
+                f"{frame_type} {total / max(count, 1):.1f}"
+                for frame_type, total in phase.frames.most_common()
+            )
+            self.stdout.write(f"  {phase.name}: {frames}")
+        if any(phase.timeouts for phase in self.phases):
+            self.stdout.write(self.style.WARNING("Some commands never got a reply."))
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive simulated users through the room and user WebSocket protocol "
+        "and report connect latency, command round trips, queries and frames."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=40)
+        parser.add_argument("--rooms", type=int, default=4)
+        parser.add_argument(
+            "--messages", type=int, default=2, help="Messages sent per user."
+        )
+        parser.add_argument(
+            "--protocol",
+            choices=["current", "legacy"],
+            default="current",
+            help="current negotiates snapshots, room_refresh, deltas and paging.",
+        )
+        parser.add_argument(
+            "--layer",
+            choices=["memory", "configured"],
+            default="memory",
+            help="memory uses InMemoryChannelLayer; configured uses CHANNEL_LAYERS.",
+        )
+        parser.add_argument("--concurrency", type=int, default=50)
+        parser.add_argument("--timeout", type=float, default=10)
+        parser.add_argument(
+            "--settle",
+            type=float,
+            default=0.25,
+            help="Seconds without frames that end a phase.",
+        )
+        parser.add_argument(
+            "--keep", action="store_true", help="Keep the simulated users and rooms."
+        )
+
+    def handle(self, *args, **options):
+        prepare_environment(options["layer"])
+        loadtest = LoadTest(self, options)
+        try:
+            asyncio.run(loadtest.run())
+        finally:
+            if not options["keep"]:
+                self.clean_up(loadtest)
+
+    def clean_up(self, loadtest):
+        from blabhear.models import Room, User
+
+        Room.objects.filter(id__in=loadtest.room_ids).delete()
+        User.objects.filter(username__in=loadtest.usernames).delete()
@@ -0,0 +1,196 @@
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Summary:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        with self.lock:
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def reset(self):
+        with self.lock:
+            count, total, maximum = self.count, self.total, self.max
+            self.count, self.total, self.max = 0, 0.0, 0.0
+        return count, total, maximum
+
+
+# Time a database call spends queued for a free executor thread, versus the
+# time it then spends running there, including its queries.
+db_executor_wait = Summary("db_executor_wait_seconds")
+db_executor_run = Summary("db_executor_run_seconds")
+
+last_logged = time.monotonic()
+last_logged_lock = threading.Lock()
+
+
+def log_db_executor_metrics():
+    global last_logged
+    interval = settings.DB_METRICS_LOG_INTERVAL
+    if not interval:
+        return
+    with last_logged_lock:
+        now = time.monotonic()
+        if now - last_logged < interval:
+            return
+        last_logged = now
+    waits, wait_total, wait_max = db_executor_wait.reset()
+    runs, run_total, run_max = db_executor_run.reset()
+    if runs:
+        logger.info(
+            "db executor: %d calls, wait avg %.1fms max %.1fms, "
+            "run avg %.1fms max %.1fms",
+            runs,
+            wait_total / max(waits, 1) * 1000,
+            wait_max * 1000,
+            run_total / runs * 1000,
+            run_max * 1000,
+        )
+
+
+# The command (or, for group events, the event type) the current task is
+# working for. Tasks and executor calls inherit it from whoever started them.
+current_command = contextvars.ContextVar("current_command", default="")
+
+METRIC_HELP = {
+    "blabhear_receive_seconds": (
+        "summary",
+        "Time spent dispatching an incoming frame, before handlers run.",
+    ),
+    "blabhear_command_seconds": (
+        "summary",
+        "Wall time from receiving a command until its handler finishes.",
+    ),
+    "blabhear_event_seconds": ("summary", "Time spent handling a group event."),
+    "blabhear_token_cache_hits_total": (
+        "counter",
+        "Connections whose token was found in the verified token cache.",
+    ),
+    "blabhear_token_cache_misses_total": (
+        "counter",
+        "Connections whose token had to be verified.",
+    ),
+    "blabhear_user_upserts_skipped_total": (
+        "counter",
+        "Connections whose user row was already up to date.",
+    ),
+    "blabhear_commands_collapsed_total": (
+        "counter",
+        "Fetches served by an identical fetch that had not started yet.",
+    ),
+    "blabhear_db_executor_wait_seconds": (
+        "summary",
+        "Time ORM calls spend queued for a database executor thread.",
+    ),
+    "blabhear_db_executor_run_seconds": (
+        "summary",
+        "Time ORM calls spend running on a database executor thread.",
+    ),
+    "blabhear_db_queries_total": ("counter", "Database queries executed."),
+    "blabhear_db_query_seconds_total": (
+        "counter",
+        "Time spent executing database queries.",
+    ),
+    "blabhear_channel_layer_sends_total": (
+        "counter",
+        "Messages sent through the channel layer.",
+    ),
+    "blabhear_frames_total": ("counter", "WebSocket frames sent to clients."),
+    "blabhear_frame_bytes_total": (
+        "counter",
+        "Bytes of WebSocket frames sent to clients.",
+    ),
+}
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.summaries = defaultdict(lambda: [0, 0.0])
+
+    def inc(self, name, labels, amount=1):
+        with self.lock:
+            self.counters[name, labels] += amount
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            summary = self.summaries[name, labels]
+            summary[0] += 1
+            summary[1] += value
+
+    def render(self):
+        with self.lock:
+            samples = defaultdict(list)
+            for (name, labels), value in self.counters.items():
+                samples[name].append((name, labels, value))
+            for (name, labels), (count, total) in self.summaries.items():
+                samples[name].append((f"{name}_count", labels, count))
+                samples[name].append((f"{name}_sum", labels, total))
+        lines = []
+        for name in sorted(samples):
+            metric_type, help_text = METRIC_HELP[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for sample, labels, value in sorted(samples[name]):
+                rendered = ",".join(
+                    f'{key}="{escape_label(value)}"' for key, value in labels
+                )
+                if rendered:
+                    lines.append(f"{sample}{{{rendered}}} {value:g}")
+                else:
+                    lines.append(f"{sample} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+
+
+def command_labels(**labels):
+    return (("command", current_command.get()), *sorted(labels.items()))
+
+
+def observe_query(duration, database="postgres"):
+    labels = command_labels(database=database)
+    registry.inc("blabhear_db_queries_total", labels)
+    registry.inc("blabhear_db_query_seconds_total", labels, duration)
+
+
+class QueryMetrics:
+    """
+    Execute wrapper counting and timing every query a connection runs.
+    """
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            observe_query(time.monotonic() - started)
+
+
+query_metrics = QueryMetrics()
+
+
+def install_query_metrics(sender, connection, **kwargs):
+    if query_metrics not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_metrics)
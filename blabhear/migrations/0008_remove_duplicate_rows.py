@@ -0,0 +1,53 @@
+# Generated by Django 3.2.18 on 2026-10-18 12:56
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def duplicate_groups(model, fields):
+    return (
+        model.objects.values(*fields)
+        .annotate(copies=Count("id"))
+        .filter(copies__gt=1)
+    )
+
+
+def remove_duplicates(apps, schema_editor):
+    Message = apps.get_model("blabhear", "Message")
+    JoinRequest = apps.get_model("blabhear", "JoinRequest")
+    UserNotification = apps.get_model("blabhear", "UserNotification")
+    MessageNotification = apps.get_model("blabhear", "MessageNotification")
+
+    # Keep the most recently recorded message and point everything at it.
+    for group in duplicate_groups(Message, ["room", "creator"]):
+        keep, *extra = Message.objects.filter(
+            room=group["room"], creator=group["creator"]
+        ).order_by("-updated_at")
+        extra_ids = [message.id for message in extra]
+        UserNotification.objects.filter(message_id__in=extra_ids).update(message=keep)
+        MessageNotification.objects.filter(message_id__in=extra_ids).update(
+            message=keep
+        )
+        Message.objects.filter(id__in=extra_ids).delete()
+
+    for model, fields, latest in [
+        (JoinRequest, ["user", "room"], "-timestamp"),
+        (UserNotification, ["user", "room"], "-timestamp"),
+        (MessageNotification, ["receiver", "room", "message"], "-timestamp"),
+    ]:
+        for group in duplicate_groups(model, fields):
+            keep, *extra = model.objects.filter(
+                **{field: group[field] for field in fields}
+            ).order_by(latest)
+            model.objects.filter(id__in=[row.id for row in extra]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blabhear', '0007_alter_messagenotification_message'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.18 on 2026-10-18 12:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blabhear', '0008_remove_duplicate_rows'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='joinrequest',
+            constraint=models.UniqueConstraint(fields=('user', 'room'), name='unique_join_request_per_user_in_room'),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('room', 'creator'), name='unique_message_per_creator_in_room'),
+        ),
+        migrations.AddConstraint(
+            model_name='messagenotification',
+            constraint=models.UniqueConstraint(fields=('receiver', 'room', 'message'), name='unique_message_notification_per_receiver'),
+        ),
+        migrations.AddConstraint(
+            model_name='usernotification',
+            constraint=models.UniqueConstraint(fields=('user', 'room'), name='unique_user_notification_per_room'),
+        ),
+    ]
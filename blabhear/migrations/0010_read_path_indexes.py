@@ -0,0 +1,21 @@
+# Generated by Django 3.2.18 on 2026-10-18 12:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blabhear', '0009_unique_constraints'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='joinrequest',
+            index=models.Index(fields=['room', '-timestamp'], name='joinrequest_room_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messagenotification',
+            index=models.Index(fields=['receiver', 'room', 'read', '-timestamp', '-id'], include=('message',), name='msgnotif_recv_room_read_ts_idx'),
+        ),
+    ]
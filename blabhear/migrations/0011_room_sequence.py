@@ -0,0 +1,18 @@
+# Generated by Django 3.2.18 on 2026-10-18 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blabhear', '0010_read_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='sequence',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
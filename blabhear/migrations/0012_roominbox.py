@@ -0,0 +1,51 @@
+# Generated by Django 3.2.18 on 2026-10-18 13:06
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blabhear', '0011_room_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomInbox',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('room_display_name', models.CharField(blank=True, max_length=150)),
+                ('last_sender_name', models.CharField(blank=True, max_length=150, null=True)),
+                ('last_activity', models.DateTimeField(default=django.utils.timezone.now)),
+                ('read', models.BooleanField(default=False)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='roominbox',
+            name='last_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='roominbox',
+            name='room',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='blabhear.room'),
+        ),
+        migrations.AddField(
+            model_name='roominbox',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='roominbox',
+            index=models.Index(fields=['user', 'read', '-last_activity', '-id'], include=('room', 'room_display_name', 'last_sender_name', 'unread_count'), name='roominbox_user_read_act_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='roominbox',
+            constraint=models.UniqueConstraint(fields=('user', 'room'), name='unique_inbox_per_user_room'),
+        ),
+    ]
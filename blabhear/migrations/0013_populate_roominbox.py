@@ -0,0 +1,56 @@
+# Generated by Django 3.2.18 on 2026-10-18 13:07
+
+from django.db import migrations
+from django.db.models import Count, F
+
+
+def populate_inbox(apps, schema_editor):
+    UserNotification = apps.get_model("blabhear", "UserNotification")
+    MessageNotification = apps.get_model("blabhear", "MessageNotification")
+    RoomInbox = apps.get_model("blabhear", "RoomInbox")
+
+    unread_counts = {
+        (row["receiver"], row["room"]): row["count"]
+        for row in MessageNotification.objects.filter(
+            read=False, message__creator__room=F("room")
+        )
+        .values("receiver", "room")
+        .annotate(count=Count("id"))
+    }
+    notifications = UserNotification.objects.values(
+        "user",
+        "room",
+        "room__display_name",
+        "read",
+        "timestamp",
+        "message__creator",
+        "message__creator__display_name",
+    )
+    RoomInbox.objects.bulk_create(
+        (
+            RoomInbox(
+                user_id=row["user"],
+                room_id=row["room"],
+                room_display_name=row["room__display_name"],
+                last_sender_id=row["message__creator"],
+                last_sender_name=row["message__creator__display_name"],
+                last_activity=row["timestamp"],
+                read=row["read"],
+                unread_count=unread_counts.get((row["user"], row["room"]), 0),
+            )
+            for row in notifications.iterator()
+        ),
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blabhear', '0012_roominbox'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_inbox, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,8 @@
 import uuid
 
 from django.contrib.auth.models import AbstractUser
-from django.core.exceptions import ValidationError
 from django.db import models
-from django.utils.translation import gettext_lazy as _
+from django.utils import timezone
 
 
 class User(AbstractUser):
@@ -22,6 +21,7 @@ class Room(models.Model):
     members = models.ManyToManyField(User)
     private = models.BooleanField(blank=False, default=False)
     display_name = models.CharField(max_length=150, blank=True)
+    sequence = models.BigIntegerField(default=0)
 
     def save(self, *args, **kwargs):
         if not self.display_name:
@@ -36,13 +36,12 @@ class Message(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
-    def save(self, *args, **kwargs):
-        other_messages = Message.objects.filter(
-            room=self.room, creator=self.creator
-        ).exclude(id=self.id)
-        if other_messages.exists():
-            raise ValidationError(_("Message must be unique per creator in room."))
-        super(Message, self).save(*args, **kwargs)
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["room", "creator"], name="unique_message_per_creator_in_room"
+            )
+        ]
 
 
 class JoinRequest(models.Model):
@@ -51,13 +50,15 @@ class JoinRequest(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
     timestamp = models.DateTimeField(auto_now_add=True)
 
-    def save(self, *args, **kwargs):
-        other_requests = JoinRequest.objects.filter(
-            user=self.user, room=self.room
-        ).exclude(id=self.id)
-        if other_requests.exists():
-            raise ValidationError(_("Join request must be unique per user in room."))
-        super(JoinRequest, self).save(*args, **kwargs)
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "room"], name="unique_join_request_per_user_in_room"
+            )
+        ]
+        indexes = [
+            models.Index(fields=["room", "-timestamp"], name="joinrequest_room_ts_idx")
+        ]
 
 
 class UserNotification(models.Model):
@@ -70,15 +71,12 @@ class UserNotification(models.Model):
         Message, blank=True, null=True, on_delete=models.SET_NULL
     )
 
-    def save(self, *args, **kwargs):
-        other_notifications = UserNotification.objects.filter(
-            user=self.user, room=self.room
-        ).exclude(id=self.id)
-        if other_notifications.exists():
-            raise ValidationError(
-                _("User notification must be unique per user in room.")
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "room"], name="unique_user_notification_per_room"
             )
-        super(UserNotification, self).save(*args, **kwargs)
+        ]
 
 
 class MessageNotification(models.Model):
@@ -89,14 +87,54 @@ class MessageNotification(models.Model):
     read = models.BooleanField(default=False)
     message = models.ForeignKey(Message, on_delete=models.CASCADE)
 
-    def save(self, *args, **kwargs):
-        other_notifications = MessageNotification.objects.filter(
-            receiver=self.receiver, room=self.room, message=self.message
-        ).exclude(id=self.id)
-        if other_notifications.exists():
-            raise ValidationError(
-                _(
-                    "Message notification must be unique per receiver and per message in room."
-                )
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["receiver", "room", "message"],
+                name="unique_message_notification_per_receiver",
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=["receiver", "room", "read", "-timestamp", "-id"],
+                name="msgnotif_recv_room_read_ts_idx",
+                include=["message"],
+            )
+        ]
+
+
+class RoomInbox(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+    room_display_name = models.CharField(max_length=150, blank=True)
+    last_sender = models.ForeignKey(
+        User,
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name="+",
+    )
+    last_sender_name = models.CharField(max_length=150, blank=True, null=True)
+    last_activity = models.DateTimeField(default=timezone.now)
+    read = models.BooleanField(default=False)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "room"], name="unique_inbox_per_user_room"
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=["user", "read", "-last_activity", "-id"],
+                name="roominbox_user_read_act_idx",
+                include=[
+                    "room",
+                    "room_display_name",
+                    "last_sender_name",
+                    "unread_count",
+                ],
             )
-        super(MessageNotification, self).save(*args, **kwargs)
+        ]
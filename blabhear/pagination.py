@@ -0,0 +1,88 @@
+import base64
+import json
+import logging
+import uuid
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+
+def page_size_from(content):
+    try:
+        page_size = int(content.get("page_size") or settings.NOTIFICATION_PAGE_SIZE)
+    except (TypeError, ValueError):
+        page_size = settings.NOTIFICATION_PAGE_SIZE
+    return max(1, min(page_size, settings.NOTIFICATION_PAGE_SIZE_MAX))
+
+
+class PagedConsumer:
+    """
+    Pages notification lists for sockets that asked for paging. Other
+    sockets get whole lists.
+    """
+
+    paging_protocol = False
+
+    def page_size(self, content):
+        return page_size_from(content) if self.paging_protocol else None
+
+
+def encode_cursor(row, timestamp_field):
+    position = [row["read"], row[timestamp_field].isoformat(), str(row["id"])]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        read, timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor))
+        timestamp = parse_datetime(timestamp)
+        row_id = uuid.UUID(row_id)
+    except (AttributeError, TypeError, ValueError):
+        timestamp = None
+    if timestamp is None:
+        raise ValueError(f"Invalid cursor {cursor!r}.")
+    return bool(read), timestamp, row_id
+
+
+def cursor_position(cursor):
+    if not cursor:
+        return None
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        logger.warning("Ignoring invalid cursor %r", cursor)
+        return None
+
+
+def page_queryset(queryset, cursor, page_size, timestamp_field="timestamp"):
+    # Unread first, newest first, with the id breaking timestamp ties. One
+    # extra row is fetched to tell whether there is a next page, and a
+    # page_size of None returns every row after the cursor.
+    position = cursor_position(cursor)
+    if position is not None:
+        read, timestamp, row_id = position
+        queryset = queryset.filter(
+            Q(read__gt=read)
+            | Q(read=read, **{f"{timestamp_field}__lt": timestamp})
+            | Q(read=read, **{timestamp_field: timestamp}, id__lt=row_id)
+        )
+    queryset = queryset.order_by("read", f"-{timestamp_field}", "-id")
+    if page_size is None:
+        return queryset
+    return queryset[: page_size + 1]
+
+
+def split_page(rows, page_size, timestamp_field="timestamp"):
+    next_cursor = None
+    if page_size is not None and len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows[-1], timestamp_field)
+    return rows, next_cursor
+
+
+def paginate(queryset, cursor, page_size, timestamp_field="timestamp"):
+    rows = list(page_queryset(queryset, cursor, page_size, timestamp_field))
+    return split_page(rows, page_size, timestamp_field)
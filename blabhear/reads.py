@@ -0,0 +1,162 @@
+import asyncio
+import time
+import uuid
+
+import asyncpg
+from django.conf import settings
+
+from blabhear.metrics import observe_query
+from blabhear.models import (
+    JoinRequest,
+    Message,
+    MessageNotification,
+    Room,
+    RoomInbox,
+    User,
+)
+from blabhear.pagination import cursor_position, split_page
+
+# Read-only hot paths served straight from asyncpg, skipping the executor
+# hop. Writes stay on the ORM. Column aliases match the ORM .values() keys so
+# the same serializers apply.
+
+ROOM_METADATA_SQL = f"""
+    SELECT room.id, room.display_name, room.private,
+           member.id AS member_id, member.username, member.display_name AS name
+    FROM {Room._meta.db_table} room
+    LEFT JOIN {Room.members.through._meta.db_table} membership
+        ON membership.room_id = room.id
+    LEFT JOIN {User._meta.db_table} member ON member.id = membership.user_id
+    WHERE room.id = $1
+"""
+
+JOIN_REQUESTS_SQL = f"""
+    SELECT request.user_id AS "user", requester.username AS "user__username",
+           requester.display_name AS "user__display_name"
+    FROM {JoinRequest._meta.db_table} request
+    JOIN {User._meta.db_table} requester ON requester.id = request.user_id
+    WHERE request.room_id = $1
+    ORDER BY request.timestamp DESC
+"""
+
+MESSAGE_NOTIFICATIONS_SQL = f"""
+    SELECT notification.id, notification.message_id AS "message__id",
+           notification.read, notification.timestamp,
+           creator.display_name AS "message__creator__display_name"
+    FROM {MessageNotification._meta.db_table} notification
+    JOIN {Message._meta.db_table} message ON message.id = notification.message_id
+    JOIN {User._meta.db_table} creator ON creator.id = message.creator_id
+    WHERE notification.receiver_id = $1 AND notification.room_id = $2
+      AND message.creator_id IN (
+          SELECT user_id FROM {Room.members.through._meta.db_table}
+          WHERE room_id = $2
+      )
+      {{after}}
+    ORDER BY notification.read, notification.timestamp DESC, notification.id DESC
+    LIMIT $3
+"""
+
+USER_NOTIFICATIONS_SQL = f"""
+    SELECT id, room_id AS room, room_display_name, read, last_activity,
+           last_sender_name, unread_count
+    FROM {RoomInbox._meta.db_table} notification
+    WHERE user_id = $1
+      {{after}}
+    ORDER BY read, last_activity DESC, id DESC
+    LIMIT $2
+"""
+
+
+def after_position(first_parameter, timestamp_column):
+    read, timestamp, row_id = (f"${first_parameter + offset}" for offset in range(3))
+    return f"""
+      AND (notification.read > {read}
+           OR (notification.read = {read}
+               AND (notification.{timestamp_column} < {timestamp}
+                    OR (notification.{timestamp_column} = {timestamp}
+                        AND notification.id < {row_id}))))
+    """
+
+
+class AsyncReads:
+    def __init__(self):
+        self.pools = {}
+
+    async def pool(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self.pools:
+            self.pools[loop] = asyncio.ensure_future(self.create_pool())
+        return await self.pools[loop]
+
+    async def create_pool(self):
+        database = settings.DATABASES["default"]
+        return await asyncpg.create_pool(
+            host=database.get("HOST") or None,
+            port=database.get("PORT") or None,
+            user=database.get("USER") or None,
+            password=database.get("PASSWORD") or None,
+            database=database.get("NAME") or None,
+            min_size=1,
+            max_size=settings.ASYNC_DB_POOL_SIZE,
+            # pgbouncer in transaction mode cannot keep prepared statements.
+            statement_cache_size=0 if settings.DATABASE_POOL == "pgbouncer" else 100,
+        )
+
+    async def fetch(self, sql, *args):
+        pool = await self.pool()
+        if not settings.METRICS_ENABLED:
+            return await pool.fetch(sql, *args)
+        started = time.monotonic()
+        try:
+            return await pool.fetch(sql, *args)
+        finally:
+            observe_query(time.monotonic() - started, database="asyncpg")
+
+    async def room_metadata(self, room_id):
+        rows = await self.fetch(ROOM_METADATA_SQL, uuid.UUID(str(room_id)))
+        if not rows:
+            return None
+        members = [row for row in rows if row["member_id"] is not None]
+        return {
+            "id": str(rows[0]["id"]),
+            "display_name": rows[0]["display_name"],
+            "private": rows[0]["private"],
+            "member_ids": [str(row["member_id"]) for row in members],
+            "member_usernames": [row["username"] for row in members],
+            "members": [row["name"] for row in members],
+        }
+
+    async def join_requests(self, room_id):
+        rows = await self.fetch(JOIN_REQUESTS_SQL, uuid.UUID(str(room_id)))
+        return [dict(row) for row in rows]
+
+    async def page(self, sql, timestamp_column, args, cursor, page_size):
+        position = cursor_position(cursor)
+        # LIMIT NULL is no limit.
+        limit = None if page_size is None else page_size + 1
+        if position is None:
+            sql = sql.format(after="")
+            args = [*args, limit]
+        else:
+            read, timestamp, row_id = position
+            sql = sql.format(after=after_position(len(args) + 2, timestamp_column))
+            args = [*args, limit, read, timestamp, row_id]
+        rows = [dict(row) for row in await self.fetch(sql, *args)]
+        return split_page(rows, page_size, timestamp_column)
+
+    async def message_notifications(self, user_id, room_id, cursor, page_size):
+        return await self.page(
+            MESSAGE_NOTIFICATIONS_SQL,
+            "timestamp",
+            [user_id, uuid.UUID(str(room_id))],
+            cursor,
+            page_size,
+        )
+
+    async def user_notifications(self, user_id, cursor, page_size):
+        return await self.page(
+            USER_NOTIFICATIONS_SQL, "last_activity", [user_id], cursor, page_size
+        )
+
+
+async_reads = AsyncReads()
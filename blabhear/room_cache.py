@@ -0,0 +1,178 @@
+import asyncio
+import json
+import logging
+
+import aioredis
+from cachetools import LRUCache, TTLCache
+from django.conf import settings
+
+from blabhear.executors import database_sync_to_async
+from blabhear.models import Room
+from blabhear.reads import async_reads
+
+logger = logging.getLogger(__name__)
+
+# Deltas for these facets change what load_room_metadata returns.
+ROOM_METADATA_FACETS = {"display_name", "members", "privacy"}
+
+# Stores metadata only if no invalidation has bumped the room's generation
+# since the loader read it.
+SHARED_SET_LUA = """
+    if tonumber(redis.call('GET', KEYS[1]) or '0') == tonumber(ARGV[1]) then
+        redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+    end
+"""
+
+
+def load_room_metadata(room_id):
+    room, created = Room.objects.get_or_create(id=room_id)
+    members = list(room.members.values_list("id", "username", "display_name"))
+    return {
+        "id": str(room.id),
+        "display_name": room.display_name,
+        "private": room.private,
+        "member_ids": [str(member_id) for member_id, username, name in members],
+        "member_usernames": [username for member_id, username, name in members],
+        "members": [name for member_id, username, name in members],
+    }
+
+
+def redis_address():
+    # Reuse the channel layer's Redis; without one the cache is process-local.
+    config = settings.CHANNEL_LAYERS["default"].get("CONFIG", {})
+    hosts = config.get("hosts") or [None]
+    host = hosts[0]
+    if isinstance(host, dict):
+        return host.get("address")
+    return host
+
+
+class RoomMetadataCache:
+    def __init__(self):
+        self.local = TTLCache(
+            maxsize=settings.ROOM_CACHE_SIZE, ttl=settings.ROOM_CACHE_LOCAL_TTL
+        )
+        self.versions = LRUCache(maxsize=settings.ROOM_CACHE_SIZE)
+        self.forgotten = LRUCache(maxsize=settings.ROOM_CACHE_SIZE)
+        self.loading = {}
+        self.pools = {}
+
+    def key(self, room_id):
+        return f"blabhear:room:{room_id}"
+
+    def generation_key(self, room_id):
+        return f"blabhear:room:{room_id}:generation"
+
+    async def redis(self):
+        address = redis_address()
+        if address is None:
+            return None
+        loop = asyncio.get_running_loop()
+        if loop not in self.pools:
+            self.pools[loop] = await aioredis.create_redis_pool(address)
+        return self.pools[loop]
+
+    async def get(self, room_id):
+        room_id = str(room_id)
+        metadata = self.local.get(room_id)
+        if metadata is not None:
+            return metadata
+        # Sockets asking for the same room at once share one load.
+        loading = self.loading.get(room_id)
+        if loading is None:
+            loading = asyncio.ensure_future(self.load(room_id))
+            self.loading[room_id] = loading
+            loading.add_done_callback(lambda done: self.finished(room_id, done))
+        return await asyncio.shield(loading)
+
+    def finished(self, room_id, loading):
+        if self.loading.get(room_id) is loading:
+            del self.loading[room_id]
+
+    async def load(self, room_id):
+        version = self.versions.get(room_id, 0)
+        # The generation is read before the database, so a change committed
+        # after it is caught by the generation check when the result is
+        # shared, even if this process has not seen the change's delta yet.
+        generation, metadata = await self.shared_get(room_id)
+        if metadata is None:
+            if settings.ASYNC_DB_READS:
+                metadata = await async_reads.room_metadata(room_id)
+            if metadata is None:
+                metadata = await database_sync_to_async(load_room_metadata)(room_id)
+            if generation is not None and self.versions.get(room_id, 0) == version:
+                await self.shared_set(room_id, generation, metadata)
+        # Results that raced an invalidation are returned but not kept.
+        if self.versions.get(room_id, 0) == version:
+            self.local[room_id] = metadata
+        return metadata
+
+    async def shared_get(self, room_id):
+        # Returns the room's current generation, or None without Redis, and
+        # the cached metadata if it was stored at that generation.
+        try:
+            redis = await self.redis()
+            if redis is None:
+                return None, None
+            cached, generation = await redis.mget(
+                self.key(room_id), self.generation_key(room_id)
+            )
+        except (aioredis.RedisError, OSError):
+            logger.warning("Room cache read failed for %s", room_id, exc_info=True)
+            return None, None
+        generation = int(generation or 0)
+        if cached:
+            cached = json.loads(cached)
+            if cached.get("generation") == generation:
+                return generation, cached["metadata"]
+        return generation, None
+
+    async def shared_set(self, room_id, generation, metadata):
+        try:
+            redis = await self.redis()
+            if redis is not None:
+                await redis.eval(
+                    SHARED_SET_LUA,
+                    keys=[self.generation_key(room_id), self.key(room_id)],
+                    args=[
+                        generation,
+                        json.dumps({"generation": generation, "metadata": metadata}),
+                        settings.ROOM_CACHE_TTL,
+                    ],
+                )
+        except (aioredis.RedisError, OSError):
+            logger.warning("Room cache write failed for %s", room_id, exc_info=True)
+
+    def forget(self, room_id, sequence=None):
+        # Drops only this process's copy; every process with a socket in the
+        # room does this when the room's delta or refresh event arrives. A
+        # sequenced delta is only acted on by the first socket that sees it,
+        # so the other sockets share one reload instead of restarting it.
+        room_id = str(room_id)
+        if sequence is not None:
+            if sequence <= self.forgotten.get(room_id, 0):
+                return
+            self.forgotten[room_id] = sequence
+        self.versions[room_id] = self.versions.get(room_id, 0) + 1
+        self.local.pop(room_id, None)
+        self.loading.pop(room_id, None)
+
+    async def invalidate(self, room_id, sequence=None):
+        # Call after the change has committed and before broadcasting it.
+        self.forget(room_id, sequence)
+        try:
+            redis = await self.redis()
+            if redis is not None:
+                transaction = redis.multi_exec()
+                transaction.incr(self.generation_key(room_id))
+                # Outlives any entry stored at an older generation.
+                transaction.expire(
+                    self.generation_key(room_id), 2 * settings.ROOM_CACHE_TTL
+                )
+                transaction.delete(self.key(room_id))
+                await transaction.execute()
+        except (aioredis.RedisError, OSError):
+            logger.warning("Room cache delete failed for %s", room_id, exc_info=True)
+
+
+room_cache = RoomMetadataCache()
@@ -0,0 +1,139 @@
+import asyncio
+import json
+
+from django.conf import settings
+
+from blabhear.metrics import command_labels, registry
+
+
+class CommandScheduler:
+    """
+    Runs one connection's commands as tasks, at most `concurrency` at a time.
+    Mutating commands keep arrival order: each waits for every command
+    received before it, and commands received after it wait for it. Reads
+    between two writes may overlap. A read identical to one that has not
+    started yet is served by that one, and a read identical to one that is
+    running waits for it, so repeats of a read collapse into at most one
+    trailing rerun.
+    """
+
+    def __init__(self, concurrency, queue_size):
+        self.slots = asyncio.Semaphore(concurrency)
+        self.queue_size = queue_size
+        self.tasks = {}
+        self.last_write = None
+        self.reads_since_write = set()
+        # Reads submitted since the last write that have not started, by key.
+        self.waiting = {}
+        # Reads that have started and not finished, by key.
+        self.running = {}
+
+    def submit(self, coroutine, mutating=False, key=None):
+        # Returns None, without running the command, when the queue is full.
+        if len(self.tasks) >= self.queue_size:
+            coroutine.close()
+            return None
+        if mutating:
+            waits_for = {*self.reads_since_write}
+        else:
+            waits_for = set()
+        if self.last_write is not None:
+            waits_for.add(self.last_write)
+        if key is not None and key in self.running:
+            waits_for.add(self.running[key])
+        task = asyncio.create_task(self.run(coroutine, waits_for, key))
+        self.tasks[task] = coroutine, key
+        task.add_done_callback(self.finished)
+        if mutating:
+            self.last_write = task
+            self.reads_since_write = set()
+            self.waiting = {}
+        else:
+            self.reads_since_write.add(task)
+            if key is not None:
+                self.waiting[key] = task
+        return task
+
+    def pending(self, key):
+        """
+        Returns the read with this key that is still waiting to start, if any.
+        Once it starts, the next duplicate is submitted as the rerun that waits
+        for it, and later duplicates are served by that rerun.
+        """
+        return self.waiting.get(key)
+
+    async def run(self, coroutine, waits_for, key):
+        if waits_for:
+            await asyncio.wait(waits_for)
+        async with self.slots:
+            task = asyncio.current_task()
+            self.stop_waiting(key, task)
+            if key is not None:
+                self.running[key] = task
+            await coroutine
+
+    def stop_waiting(self, key, task):
+        if key is not None and self.waiting.get(key) is task:
+            del self.waiting[key]
+
+    def stop_running(self, key, task):
+        if key is not None and self.running.get(key) is task:
+            del self.running[key]
+
+    def finished(self, task):
+        coroutine, key = self.tasks.pop(task)
+        # Only does anything if the task was cancelled before the command
+        # started, so it is not left never awaited.
+        coroutine.close()
+        self.stop_waiting(key, task)
+        self.stop_running(key, task)
+        self.reads_since_write.discard(task)
+        if task is self.last_write:
+            self.last_write = None
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+
+class ScheduledConsumer:
+    """
+    Gives a consumer a CommandScheduler for its commands, rejecting commands
+    while the connection is over its queue limit and cancelling whatever is
+    left when the socket closes.
+    """
+
+    mutating_commands = frozenset()
+
+    async def websocket_connect(self, message):
+        self.commands = CommandScheduler(
+            settings.COMMAND_CONCURRENCY, settings.COMMAND_QUEUE_SIZE
+        )
+        await super().websocket_connect(message)
+
+    async def websocket_disconnect(self, message):
+        self.commands.cancel()
+        await super().websocket_disconnect(message)
+
+    async def schedule(self, content, coroutine):
+        command = content.get("command")
+        mutating = command in self.mutating_commands
+        # Clients answer every refresh with a fetch, so the same fetch often
+        # arrives several times before the first one gets to run.
+        key = None if mutating else json.dumps(content, sort_keys=True)
+        task = self.commands.pending(key)
+        if task is not None:
+            coroutine.close()
+            if settings.METRICS_ENABLED:
+                registry.inc(
+                    "blabhear_commands_collapsed_total",
+                    command_labels(consumer=self.metrics_name),
+                )
+        else:
+            task = self.commands.submit(coroutine, mutating, key)
+        if task is None:
+            await self.send_json(
+                {"type": "command_rejected", "command": command, "reason": "busy"}
+            )
+        else:
+            self.track_command(task)
@@ -0,0 +1,25 @@
+READABLE_TIMESTAMP_FORMAT = "%d-%m-%Y %H:%M:%S"
+
+
+def serialize_message_notification(row):
+    return {
+        "id": str(row["id"]),
+        "message__id": str(row["message__id"]),
+        "read": row["read"],
+        "timestamp": str(row["timestamp"]),
+        "readable_timestamp": row["timestamp"].strftime(READABLE_TIMESTAMP_FORMAT),
+        "message__creator__display_name": row["message__creator__display_name"],
+    }
+
+
+def serialize_user_notification(row):
+    # Keeps the keys clients read before the inbox table existed.
+    return {
+        "id": str(row["id"]),
+        "room": str(row["room"]),
+        "room__display_name": row["room_display_name"],
+        "read": row["read"],
+        "unread_count": row["unread_count"],
+        "timestamp": row["last_activity"].strftime(READABLE_TIMESTAMP_FORMAT),
+        "message__creator__display_name": row["last_sender_name"],
+    }
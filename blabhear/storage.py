@@ -1,6 +1,11 @@
+import asyncio
 import datetime
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+from cachetools import TTLCache
+from django.conf import settings
 from google.cloud import storage
 from google.oauth2 import service_account
 
@@ -24,27 +29,100 @@ storage_client = storage.Client(
     project=gcp_storage_credentials["project_id"], credentials=credentials
 )
 
+SIGNED_URL_EXPIRATION = datetime.timedelta(days=7)
+# Cached URLs are only handed out for the first SIGNED_URL_CACHE_TTL seconds
+# of their life, so clients are told to refresh that much earlier.
+SIGNED_URL_REFRESH_IN = (
+    int((SIGNED_URL_EXPIRATION.total_seconds() - settings.SIGNED_URL_CACHE_TTL) * 1000)
+    - 10000
+)
+
+download_urls = TTLCache(
+    maxsize=settings.SIGNED_URL_CACHE_SIZE, ttl=settings.SIGNED_URL_CACHE_TTL
+)
+download_urls_lock = threading.Lock()
+upload_urls = TTLCache(
+    maxsize=settings.SIGNED_URL_CACHE_SIZE, ttl=settings.SIGNED_URL_CACHE_TTL
+)
+upload_urls_lock = threading.Lock()
+
+# RSA signing is CPU bound, so it gets its own small pool instead of
+# blocking the event loop or competing with database threads.
+signing_executor = ThreadPoolExecutor(
+    max_workers=settings.SIGNING_EXECUTOR_WORKERS, thread_name_prefix="url-signing"
+)
+
 
 def generate_upload_signed_url_v4(blob_name):
+    with upload_urls_lock:
+        url = upload_urls.get(blob_name)
+    if url is None:
+        url = sign_upload_url(blob_name)
+        with upload_urls_lock:
+            upload_urls[blob_name] = url
+    return url
+
+
+def sign_upload_url(blob_name):
     bucket = storage_client.bucket(os.environ.get("GCP_UPLOAD_BUCKET"))
     blob = bucket.blob(blob_name)
 
     url = blob.generate_signed_url(
         version="v4",
-        expiration=datetime.timedelta(days=7),
+        expiration=SIGNED_URL_EXPIRATION,
         method="PUT",
         content_type="audio/ogg",
     )
     return url
 
 
-def generate_download_signed_url_v4(blob_name):
-    bucket = storage_client.bucket(os.environ.get("GCP_UPLOAD_BUCKET"))
+def sign_download_url(bucket, blob_name):
     blob = bucket.blob(blob_name)
 
     url = blob.generate_signed_url(
         version="v4",
-        expiration=datetime.timedelta(days=7),
+        expiration=SIGNED_URL_EXPIRATION,
         method="GET",
     )
     return url
+
+
+def generate_download_signed_urls_v4(blob_names):
+    urls = {}
+    with download_urls_lock:
+        for blob_name in blob_names:
+            url = download_urls.get(blob_name)
+            if url is not None:
+                urls[blob_name] = url
+    missing = [blob_name for blob_name in blob_names if blob_name not in urls]
+    if missing:
+        bucket = storage_client.bucket(os.environ.get("GCP_UPLOAD_BUCKET"))
+        signed = {
+            blob_name: sign_download_url(bucket, blob_name) for blob_name in missing
+        }
+        with download_urls_lock:
+            download_urls.update(signed)
+        urls.update(signed)
+    return urls
+
+
+async def generate_upload_signed_url_v4_async(blob_name):
+    with upload_urls_lock:
+        url = upload_urls.get(blob_name)
+    if url is not None:
+        return url
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        signing_executor, generate_upload_signed_url_v4, blob_name
+    )
+
+
+async def generate_download_signed_urls_v4_async(blob_names):
+    with download_urls_lock:
+        urls = {blob_name: download_urls.get(blob_name) for blob_name in blob_names}
+    if None not in urls.values():
+        return urls
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        signing_executor, generate_download_signed_urls_v4, blob_names
+    )
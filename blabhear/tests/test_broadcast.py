@@ -0,0 +1,45 @@
+import asyncio
+
+from channels.layers import get_channel_layer
+from django.test import SimpleTestCase, override_settings
+
+from blabhear.broadcast import RoomRefresher
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    ROOM_REFRESH_DEBOUNCE=0,
+)
+class RoomRefresherTests(SimpleTestCase):
+    def test_marks_are_sent_as_one_refresh(self):
+        async def refresh():
+            refresher = RoomRefresher()
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add("room", channel)
+            refresher.mark("room", ["members"])
+            refresher.mark("room", ["display_name"], ["alice"])
+            message = await asyncio.wait_for(layer.receive(channel), 1)
+            await asyncio.sleep(0)
+            return refresher, message
+
+        refresher, message = asyncio.run(refresh())
+        self.assertEqual(
+            message,
+            {
+                "type": "room_refresh",
+                "facets": {"members": None, "display_name": ["alice"]},
+            },
+        )
+        self.assertEqual(refresher.running, set())
+
+    def test_failed_flush_is_logged(self):
+        async def refresh():
+            refresher = RoomRefresher()
+            # Not a valid group name, so group_send raises.
+            refresher.mark("room id", ["members"])
+            await asyncio.gather(*refresher.running, return_exceptions=True)
+            await asyncio.sleep(0)
+
+        with self.assertLogs("blabhear.broadcast", "ERROR"):
+            asyncio.run(refresh())
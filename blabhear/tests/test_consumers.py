@@ -0,0 +1,101 @@
+import uuid
+
+from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from blabhear.consumers import RoomConsumer
+from blabhear.models import MessageNotification, Room, User
+
+
+def create_room(member_count):
+    room = Room.objects.create(id=uuid.uuid4())
+    members = User.objects.bulk_create(
+        [User(username=f"member-{uuid.uuid4().hex}") for index in range(member_count)]
+    )
+    room.members.add(*members)
+    return room, members
+
+
+def room_consumer(user, room):
+    consumer = RoomConsumer()
+    consumer.user = user
+    consumer.room_id = str(room.id)
+    consumer.paging_protocol = False
+    return consumer
+
+
+class RecordNewMessageTests(TransactionTestCase):
+    def count_queries(self, member_count):
+        room, members = create_room(member_count)
+        consumer = room_consumer(members[0], room)
+        # The first message also creates the sender's Message row.
+        consumer.record_new_message()
+        with CaptureQueriesContext(connection) as queries:
+            consumer.record_new_message()
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_members(self):
+        self.assertEqual(self.count_queries(2), self.count_queries(50))
+
+
+class RoomSnapshotTests(TransactionTestCase):
+    def test_join_snapshot_matches_its_delta(self):
+        room, members = create_room(2)
+        joining = User.objects.create(username=f"joining-{uuid.uuid4().hex}")
+        snapshot = room_consumer(joining, room).get_room_snapshot()
+        self.assertTrue(snapshot["was_added"])
+        self.assertEqual(snapshot["sequence"], snapshot["deltas"][-1]["sequence"])
+        self.assertEqual(
+            snapshot["member_usernames"], snapshot["deltas"][-1]["member_usernames"]
+        )
+        self.assertIn(joining.username, snapshot["member_usernames"])
+
+    def test_resync_only_reads(self):
+        room, members = create_room(2)
+        consumer = room_consumer(members[0], room)
+        consumer.join_room()
+        with CaptureQueriesContext(connection) as queries:
+            snapshot = consumer.get_resync_snapshot()
+        self.assertTrue(snapshot["allowed"])
+        self.assertIsNotNone(snapshot["upload_blob"])
+        for query in queries:
+            self.assertTrue(query["sql"].startswith("SELECT"), query["sql"])
+
+    def test_resync_of_a_deleted_room_creates_nothing(self):
+        room, members = create_room(1)
+        consumer = room_consumer(members[0], room)
+        room.delete()
+        snapshot = consumer.get_resync_snapshot()
+        self.assertTrue(snapshot["allowed"])
+        self.assertIsNone(snapshot["upload_blob"])
+        self.assertFalse(Room.objects.filter(id=room.id).exists())
+
+
+class MessageNotificationTests(TransactionTestCase):
+    def test_receivers_read_their_notification_by_message_id(self):
+        room, (sender, receiver, other) = create_room(3)
+        usernames, delta = room_consumer(sender, room).record_new_message()
+        # The delta is the same for every socket in the room.
+        self.assertNotIn("notification_ids", delta)
+        self.assertNotIn("id", delta["message_notification"])
+
+        message_id = delta["message_notification"]["message__id"]
+        room_consumer(receiver, room).read_unread_message_notification(
+            message_id=message_id
+        )
+        self.assertEqual(
+            dict(
+                MessageNotification.objects.filter(room=room).values_list(
+                    "receiver__username", "read"
+                )
+            ),
+            {sender.username: True, receiver.username: True, other.username: False},
+        )
+
+    def test_notifications_of_other_users_cannot_be_read(self):
+        room, (sender, receiver, other) = create_room(3)
+        room_consumer(sender, room).record_new_message()
+        notification = MessageNotification.objects.get(receiver=receiver)
+        with self.assertRaises(MessageNotification.DoesNotExist):
+            room_consumer(other, room).read_unread_message_notification(notification.id)
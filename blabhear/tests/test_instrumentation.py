@@ -0,0 +1,39 @@
+import asyncio
+
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, override_settings
+
+from blabhear.instrumentation import InstrumentedConsumer
+from blabhear.metrics import registry
+
+
+class PingConsumer(InstrumentedConsumer, AsyncJsonWebsocketConsumer):
+    metrics_name = "ping"
+    commands = frozenset(["ping"])
+
+    async def receive_json(self, content, **kwargs):
+        await self.send_json({"type": "pong"})
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    METRICS_ENABLED=True,
+)
+class InstrumentedConsumerTests(SimpleTestCase):
+    def test_unknown_commands_share_one_label(self):
+        async def send_commands():
+            communicator = WebsocketCommunicator(PingConsumer.as_asgi(), "/")
+            await communicator.connect()
+            for command in ["ping", "made_up_1", "made_up_2", ["not", "a", "name"]]:
+                await communicator.send_json_to({"command": command})
+                await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        asyncio.run(send_commands())
+        commands = {
+            dict(labels)["command"]
+            for (name, labels) in registry.counters
+            if name == "blabhear_frames_total" and ("consumer", "ping") in labels
+        }
+        self.assertEqual(commands, {"ping", "unknown"})
@@ -0,0 +1,248 @@
+import asyncio
+import base64
+import json
+import uuid
+
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from blabhear.consumers import RoomConsumer, UserConsumer
+from blabhear.models import Message, MessageNotification, Room, RoomInbox, User
+from blabhear.pagination import cursor_position
+from blabhear.reads import async_reads
+
+
+def raw_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+class CursorTests(SimpleTestCase):
+    def test_valid_cursor(self):
+        row_id = uuid.uuid4()
+        read, timestamp, decoded_id = cursor_position(
+            raw_cursor([False, "2024-01-01T00:00:00+00:00", str(row_id)])
+        )
+        self.assertFalse(read)
+        self.assertEqual(decoded_id, row_id)
+
+    def test_invalid_cursors_are_ignored(self):
+        for cursor in [
+            "not base64 json",
+            raw_cursor([False, "yesterday", str(uuid.uuid4())]),
+            raw_cursor([False, "2024-01-01T00:00:00+00:00", "not a uuid"]),
+            raw_cursor([False, "2024-01-01T00:00:00+00:00", 7]),
+            raw_cursor([False, "2024-01-01T00:00:00+00:00"]),
+        ]:
+            with self.subTest(cursor=cursor), self.assertLogs(
+                "blabhear.pagination", "WARNING"
+            ):
+                self.assertIsNone(cursor_position(cursor))
+
+
+def walk(load_page):
+    rows, cursor = load_page(None)
+    while cursor is not None:
+        page, cursor = load_page(cursor)
+        rows += page
+    return [row["id"] for row in rows]
+
+
+async def walk_async(load_page):
+    rows, cursor = await load_page(None)
+    while cursor is not None:
+        page, cursor = await load_page(cursor)
+        rows += page
+    return [str(row["id"]) for row in rows]
+
+
+def async_walk(load_page):
+    async def run():
+        try:
+            return await walk_async(load_page)
+        finally:
+            await (await async_reads.pool()).close()
+            async_reads.pools.clear()
+
+    return asyncio.run(run())
+
+
+class NotificationPagingTests(TransactionTestCase):
+    """
+    Half the rows are read and all share one timestamp, so only the id keeps
+    pages from skipping or repeating rows.
+    """
+
+    def setUp(self):
+        self.timestamp = timezone.now()
+        self.receiver = User.objects.create(username=f"receiver-{uuid.uuid4().hex}")
+
+    def create_message_notifications(self, count):
+        room = Room.objects.create(id=uuid.uuid4())
+        senders = User.objects.bulk_create(
+            [User(username=f"sender-{uuid.uuid4().hex}") for index in range(count)]
+        )
+        room.members.add(self.receiver, *senders)
+        messages = Message.objects.bulk_create(
+            [Message(room=room, creator=sender) for sender in senders]
+        )
+        MessageNotification.objects.bulk_create(
+            [
+                MessageNotification(
+                    receiver=self.receiver,
+                    room=room,
+                    message=message,
+                    read=index % 2 == 0,
+                )
+                for index, message in enumerate(messages)
+            ]
+        )
+        MessageNotification.objects.update(timestamp=self.timestamp)
+        consumer = RoomConsumer()
+        consumer.user = self.receiver
+        consumer.room_id = str(room.id)
+        return consumer
+
+    def create_inbox(self, count):
+        rooms = Room.objects.bulk_create(
+            [Room(id=uuid.uuid4()) for index in range(count)]
+        )
+        RoomInbox.objects.bulk_create(
+            [
+                RoomInbox(
+                    user=self.receiver,
+                    room=room,
+                    last_activity=self.timestamp,
+                    read=index % 2 == 0,
+                )
+                for index, room in enumerate(rooms)
+            ]
+        )
+        consumer = UserConsumer()
+        consumer.user = self.receiver
+        return consumer
+
+    def test_message_notification_pages(self):
+        consumer = self.create_message_notifications(7)
+        everything, next_cursor = consumer.get_message_notifications()
+        self.assertIsNone(next_cursor)
+        self.assertEqual(len(everything), 7)
+        expected = [row["id"] for row in everything]
+        for page_size in (1, 2, 3, 7):
+            with self.subTest(page_size=page_size):
+                self.assertEqual(
+                    walk(
+                        lambda cursor: consumer.get_message_notifications(
+                            cursor, page_size
+                        )
+                    ),
+                    expected,
+                )
+        for page_size in (None, 2):
+            with self.subTest(page_size=page_size, reads="asyncpg"):
+                self.assertEqual(
+                    async_walk(
+                        lambda cursor: async_reads.message_notifications(
+                            self.receiver.id, consumer.room_id, cursor, page_size
+                        )
+                    ),
+                    expected,
+                )
+
+    def test_user_notification_pages(self):
+        consumer = self.create_inbox(7)
+        everything, next_cursor = consumer.get_user_notifications()
+        self.assertIsNone(next_cursor)
+        self.assertEqual(len(everything), 7)
+        expected = [row["id"] for row in everything]
+        for page_size in (1, 2, 3, 7):
+            with self.subTest(page_size=page_size):
+                self.assertEqual(
+                    walk(
+                        lambda cursor: consumer.get_user_notifications(
+                            cursor, page_size
+                        )
+                    ),
+                    expected,
+                )
+        for page_size in (None, 2):
+            with self.subTest(page_size=page_size, reads="asyncpg"):
+                self.assertEqual(
+                    async_walk(
+                        lambda cursor: async_reads.user_notifications(
+                            self.receiver.id, cursor, page_size
+                        )
+                    ),
+                    expected,
+                )
+
+
+@override_settings(ASYNC_DB_READS=True)
+class NotificationBroadcastTests(TransactionTestCase):
+    """
+    A first page broadcast to every tab of a user is resized per tab.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username=f"tabs-{uuid.uuid4().hex}")
+        rooms = Room.objects.bulk_create([Room(id=uuid.uuid4()) for index in range(3)])
+        RoomInbox.objects.bulk_create(
+            [RoomInbox(user=self.user, room=room) for room in rooms]
+        )
+
+    def tab(self, paging):
+        consumer = UserConsumer()
+        consumer.user = self.user
+        consumer.channel_name = "tab"
+        consumer.paging_protocol = paging
+        return consumer
+
+    def receive(self, event, paging):
+        consumer = self.tab(paging)
+        sent = []
+
+        async def send_json(content, close=False):
+            sent.append(content)
+
+        consumer.send_json = send_json
+
+        async def run():
+            try:
+                await consumer.notifications(event)
+            finally:
+                for pool in async_reads.pools.values():
+                    await (await pool).close()
+                async_reads.pools.clear()
+
+        asyncio.run(run())
+        return sent[0]
+
+    def first_page(self, page_size, requested_by="other tab"):
+        notifications, next_cursor = self.tab(False).get_user_notifications(
+            None, page_size
+        )
+        return {
+            "type": "notifications",
+            "notifications": notifications,
+            "cursor": None,
+            "next_cursor": next_cursor,
+            "page_size": page_size,
+            "requested_by": requested_by,
+        }
+
+    def test_tab_without_paging_gets_the_whole_list(self):
+        sent = self.receive(self.first_page(2), paging=False)
+        self.assertEqual(len(sent["notifications"]), 3)
+        self.assertIsNone(sent["next_cursor"])
+        self.assertNotIn("page_size", sent)
+        self.assertNotIn("requested_by", sent)
+
+    @override_settings(NOTIFICATION_PAGE_SIZE=2)
+    def test_paging_tab_gets_its_own_page_size(self):
+        sent = self.receive(self.first_page(None), paging=True)
+        self.assertEqual(len(sent["notifications"]), 2)
+        self.assertIsNotNone(sent["next_cursor"])
+
+    def test_requesting_tab_keeps_the_page_it_asked_for(self):
+        event = self.first_page(1, requested_by="tab")
+        sent = self.receive(event, paging=True)
+        self.assertEqual(len(sent["notifications"]), 1)
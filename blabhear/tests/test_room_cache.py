@@ -0,0 +1,70 @@
+import asyncio
+import uuid
+from unittest import skipUnless
+
+from django.test import TransactionTestCase, override_settings
+
+from blabhear.models import Room
+from blabhear.reads import async_reads
+from blabhear.room_cache import RoomMetadataCache, load_room_metadata, redis_address
+
+
+def run(coroutine_function, *args):
+    # A fresh cache per call stands in for another server process sharing
+    # the same Redis.
+    async def run_with_cache():
+        cache = RoomMetadataCache()
+        try:
+            return await coroutine_function(cache, *args)
+        finally:
+            for pool in cache.pools.values():
+                pool.close()
+                await pool.wait_closed()
+            for pool in async_reads.pools.values():
+                await (await pool).close()
+            async_reads.pools.clear()
+
+    return asyncio.run(run_with_cache())
+
+
+async def generation(cache, room_id):
+    return (await cache.shared_get(room_id))[0]
+
+
+async def shared_metadata(cache, room_id):
+    return (await cache.shared_get(room_id))[1]
+
+
+@skipUnless(redis_address(), "needs the Redis channel layer")
+class RoomMetadataCacheTests(TransactionTestCase):
+    def setUp(self):
+        self.room_id = str(Room.objects.create(id=uuid.uuid4()).id)
+
+    def test_load_racing_an_invalidation_is_not_shared(self):
+        # One process reads the generation and the room, then another commits
+        # a change and invalidates before the first stores what it read.
+        loaded_at = run(generation, self.room_id)
+        stale = load_room_metadata(self.room_id)
+        Room.objects.filter(id=self.room_id).update(private=True)
+        run(RoomMetadataCache.invalidate, self.room_id)
+        run(RoomMetadataCache.shared_set, self.room_id, loaded_at, stale)
+        self.assertIsNone(run(shared_metadata, self.room_id))
+
+        fresh = load_room_metadata(self.room_id)
+        run(RoomMetadataCache.shared_set, self.room_id, loaded_at + 1, fresh)
+        self.assertTrue(run(shared_metadata, self.room_id)["private"])
+
+    def test_invalidate_bumps_the_generation_and_drops_the_entry(self):
+        loaded_at = run(generation, self.room_id)
+        metadata = load_room_metadata(self.room_id)
+        run(RoomMetadataCache.shared_set, self.room_id, loaded_at, metadata)
+        self.assertEqual(run(shared_metadata, self.room_id), metadata)
+        run(RoomMetadataCache.invalidate, self.room_id)
+        self.assertEqual(run(generation, self.room_id), loaded_at + 1)
+        self.assertIsNone(run(shared_metadata, self.room_id))
+
+    @override_settings(ASYNC_DB_READS=True)
+    def test_asyncpg_loads_are_shared(self):
+        metadata = run(RoomMetadataCache.get, self.room_id)
+        self.assertEqual(metadata["id"], self.room_id)
+        self.assertEqual(run(shared_metadata, self.room_id), metadata)
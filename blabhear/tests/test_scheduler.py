@@ -0,0 +1,57 @@
+import asyncio
+
+from django.test import SimpleTestCase
+
+from blabhear.scheduler import CommandScheduler
+
+
+class CommandSchedulerTests(SimpleTestCase):
+    def test_identical_reads_collapse_into_one_rerun(self):
+        started = []
+        running = []
+
+        async def fetch():
+            started.append(len(running))
+            running.append(None)
+            await asyncio.sleep(0.01)
+            running.pop()
+
+        async def submit_repeats():
+            scheduler = CommandScheduler(4, 32)
+            tasks = set()
+            for repeat in range(5):
+                coroutine = fetch()
+                task = scheduler.pending("fetch")
+                if task is None:
+                    task = scheduler.submit(coroutine, key="fetch")
+                else:
+                    coroutine.close()
+                tasks.add(task)
+                await asyncio.sleep(0.001)
+            await asyncio.gather(*tasks)
+            return tasks
+
+        tasks = asyncio.run(submit_repeats())
+        # The first fetch, then a single rerun for everything that arrived
+        # while it ran, never overlapping.
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(started, [0, 0])
+
+    def test_writes_wait_for_earlier_reads(self):
+        order = []
+
+        async def command(name, duration):
+            await asyncio.sleep(duration)
+            order.append(name)
+
+        async def submit_all():
+            scheduler = CommandScheduler(4, 32)
+            tasks = [
+                scheduler.submit(command("read", 0.01), key="read"),
+                scheduler.submit(command("write", 0), mutating=True),
+                scheduler.submit(command("read after write", 0), key="read"),
+            ]
+            await asyncio.gather(*tasks)
+
+        asyncio.run(submit_all())
+        self.assertEqual(order, ["read", "write", "read after write"])
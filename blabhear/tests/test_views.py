@@ -0,0 +1,33 @@
+from django.test import SimpleTestCase, override_settings
+
+
+@override_settings(
+    METRICS_ENABLED=True,
+    METRICS_TOKEN="secret",
+    METRICS_ALLOWED_IPS=["10.0.0.0/8"],
+)
+class MetricsViewTests(SimpleTestCase):
+    def test_token(self):
+        response = self.client.get("/metrics/", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+
+    def test_allowed_address(self):
+        response = self.client.get("/metrics/", REMOTE_ADDR="10.1.2.3")
+        self.assertEqual(response.status_code, 200)
+
+    def test_refused(self):
+        for headers in [{}, {"HTTP_AUTHORIZATION": "Bearer wrong"}]:
+            with self.subTest(headers=headers):
+                response = self.client.get("/metrics/", **headers)
+                self.assertEqual(response.status_code, 404)
+
+    @override_settings(METRICS_TOKEN="", METRICS_ALLOWED_IPS=[])
+    def test_closed_without_token_or_addresses(self):
+        response = self.client.get("/metrics/", HTTP_AUTHORIZATION="Bearer ")
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_disabled(self):
+        response = self.client.get("/metrics/", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 404)
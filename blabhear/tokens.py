@@ -0,0 +1,127 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+
+import jwt
+import requests
+from django.conf import settings
+
+from blabhear.exceptions import InvalidFirebaseAuthToken
+
+logger = logging.getLogger(__name__)
+
+FIREBASE_JWKS_URL = "https://www.googleapis.com/service_accounts/v1/jwk/securetoken@system.gserviceaccount.com"
+MAX_AGE_PATTERN = re.compile(r"max-age=(\d+)")
+
+
+class FirebaseKeySet:
+    def __init__(self, url=FIREBASE_JWKS_URL, fixture=None):
+        self.url = url
+        self.keys = {}
+        self.expires_at = 0
+        self.static = fixture is not None
+        self._refresh_task = None
+        self._initial_fetch = None
+        if fixture is not None:
+            self.load(fixture)
+
+    def load(self, jwks, max_age=None):
+        keys = {
+            key.key_id: key
+            for key in jwt.PyJWKSet.from_dict(jwks).keys
+            if key.key_id is not None
+        }
+        self.keys = keys
+        if max_age is not None:
+            self.expires_at = time.time() + max_age
+
+    def fetch(self):
+        response = requests.get(self.url, timeout=settings.FIREBASE_JWKS_TIMEOUT)
+        response.raise_for_status()
+        match = MAX_AGE_PATTERN.search(response.headers.get("Cache-Control", ""))
+        max_age = int(match.group(1)) if match else settings.FIREBASE_JWKS_MIN_REFRESH
+        self.load(response.json(), max_age)
+        return max_age
+
+    async def refresh_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                max_age = await loop.run_in_executor(None, self.fetch)
+                delay = max(max_age * 0.9, settings.FIREBASE_JWKS_MIN_REFRESH)
+            except Exception:
+                logger.exception("Failed to refresh Firebase signing keys")
+                delay = settings.FIREBASE_JWKS_RETRY
+            await asyncio.sleep(delay)
+
+    async def ready(self):
+        if self.static:
+            return
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self.refresh_forever())
+        if not self.keys:
+            # Only the very first handshakes wait on the network.
+            if self._initial_fetch is None or self._initial_fetch.done():
+                loop = asyncio.get_running_loop()
+                self._initial_fetch = loop.run_in_executor(None, self.fetch)
+            try:
+                await asyncio.shield(self._initial_fetch)
+            except Exception as exc:
+                raise InvalidFirebaseAuthToken(
+                    f"Firebase signing keys unavailable: {exc}"
+                )
+
+    def signing_key(self, kid):
+        try:
+            return self.keys[kid]
+        except KeyError:
+            raise InvalidFirebaseAuthToken(f"Unknown signing key id {kid!r}.")
+
+    def verify(self, token, project_id):
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.InvalidTokenError as exc:
+            raise InvalidFirebaseAuthToken(str(exc))
+        if header.get("alg") != "RS256":
+            raise InvalidFirebaseAuthToken("ID token must be signed with RS256.")
+        signing_key = self.signing_key(header.get("kid"))
+        try:
+            decoded_token = jwt.decode(
+                token,
+                key=signing_key.key,
+                algorithms=["RS256"],
+                audience=project_id,
+                issuer=f"https://securetoken.google.com/{project_id}",
+                leeway=settings.FIREBASE_CLOCK_SKEW,
+                options={"require": ["exp", "iat", "aud", "iss", "sub"]},
+            )
+        except jwt.InvalidTokenError as exc:
+            raise InvalidFirebaseAuthToken(str(exc))
+        subject = decoded_token["sub"]
+        if not isinstance(subject, str) or not subject or len(subject) > 128:
+            raise InvalidFirebaseAuthToken("ID token has an invalid subject.")
+        if (
+            decoded_token.get("auth_time", 0)
+            > time.time() + settings.FIREBASE_CLOCK_SKEW
+        ):
+            raise InvalidFirebaseAuthToken("ID token auth_time is in the future.")
+        decoded_token["uid"] = subject
+        return decoded_token
+
+
+def load_keyset():
+    fixture_path = settings.FIREBASE_JWKS_FIXTURE
+    if fixture_path:
+        with open(fixture_path) as fixture:
+            return FirebaseKeySet(fixture=json.load(fixture))
+    return FirebaseKeySet()
+
+
+firebase_keys = load_keyset()
+
+
+def verify_id_token(token):
+    return firebase_keys.verify(token, os.environ.get("FIREBASE_PROJECT_ID"))
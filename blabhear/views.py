@@ -0,0 +1,34 @@
+import hmac
+import ipaddress
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+
+from blabhear.metrics import registry
+
+
+def metrics_allowed(request):
+    authorization = request.headers.get("Authorization", "")
+    if settings.METRICS_TOKEN and hmac.compare_digest(
+        authorization.encode(), f"Bearer {settings.METRICS_TOKEN}".encode()
+    ):
+        return True
+    # REMOTE_ADDR is the direct peer: behind a proxy every request shares the
+    # proxy's address, so scrape with the token there instead.
+    try:
+        address = ipaddress.ip_address(request.META.get("REMOTE_ADDR") or "")
+    except ValueError:
+        return False
+    return any(
+        address in ipaddress.ip_network(network, strict=False)
+        for network in settings.METRICS_ALLOWED_IPS
+    )
+
+
+def metrics(request):
+    # Refused scrapes look the same as a disabled endpoint.
+    if not settings.METRICS_ENABLED or not metrics_allowed(request):
+        raise Http404
+    return HttpResponse(
+        registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
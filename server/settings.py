@@ -86,6 +86,32 @@ WSGI_APPLICATION = "server.wsgi.application"
 
 DATABASES = {"default": dj_database_url.config(conn_max_age=600)}
 
+# ORM calls from consumers run on a bounded thread pool, one connection per
+# thread at most. DATABASE_POOL shares connections further: "pgbouncer" when
+# a transaction-pooling pgbouncer sits in front of Postgres, "process" for an
+# in-process pool, or empty to keep a persistent connection per thread.
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", 8))
+DB_METRICS_LOG_INTERVAL = float(os.environ.get("DB_METRICS_LOG_INTERVAL", 60))
+DATABASE_POOL = os.environ.get("DATABASE_POOL", "")
+if DATABASE_POOL == "pgbouncer":
+    DATABASES["default"]["DISABLE_SERVER_SIDE_CURSORS"] = True
+elif DATABASE_POOL == "process":
+    DATABASES["default"].update(
+        {
+            "ENGINE": "blabhear.db.postgresql_pool",
+            "CONN_MAX_AGE": 0,
+            "POOL_MIN_IDLE": int(os.environ.get("DATABASE_POOL_MIN_IDLE", 2)),
+            "POOL_MAX_CONNECTIONS": int(
+                os.environ.get("DATABASE_POOL_MAX_CONNECTIONS", DB_EXECUTOR_WORKERS + 2)
+            ),
+        }
+    )
+
+# Serve the hottest read-only consumer queries through asyncpg instead of the
+# ORM executor.
+ASYNC_DB_READS = bool(os.environ.get("ASYNC_DB_READS") == "True")
+ASYNC_DB_POOL_SIZE = int(os.environ.get("ASYNC_DB_POOL_SIZE", 10))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -136,14 +162,79 @@ LOCAL = bool(os.environ.get("LOCAL") == "True")
 
 ASGI_APPLICATION = "server.asgi.application"
 
+# "redis" queues a copy of each group message per channel; "pubsub" has each
+# process subscribe once per group and fan messages out to its own sockets.
+CHANNEL_LAYER_MODE = os.environ.get("CHANNEL_LAYER_MODE", "redis")
+CHANNEL_LAYER_BACKENDS = {
+    "redis": "blabhear.layers.RedisChannelLayer",
+    "pubsub": "blabhear.layers.RedisPubSubChannelLayer",
+}
+
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": CHANNEL_LAYER_BACKENDS[CHANNEL_LAYER_MODE],
         "CONFIG": {
             "hosts": [os.environ.get("REDIS_URL")],
         },
     },
 }
+
+# Verified Firebase ID tokens are cached so reconnects skip verification.
+# Entries never outlive the token's own exp claim.
+TOKEN_CACHE_MAXSIZE = int(os.environ.get("TOKEN_CACHE_MAXSIZE", 10000))
+TOKEN_CACHE_TTL = int(os.environ.get("TOKEN_CACHE_TTL", 300))
+
+# ID tokens are verified locally against Google's published keyset, which a
+# background task refreshes as Cache-Control allows. Point
+# FIREBASE_JWKS_FIXTURE at a JWKS file to pin the keyset (e.g. for tests).
+FIREBASE_JWKS_FIXTURE = os.environ.get("FIREBASE_JWKS_FIXTURE")
+FIREBASE_JWKS_TIMEOUT = float(os.environ.get("FIREBASE_JWKS_TIMEOUT", 5))
+FIREBASE_JWKS_MIN_REFRESH = int(os.environ.get("FIREBASE_JWKS_MIN_REFRESH", 300))
+FIREBASE_JWKS_RETRY = int(os.environ.get("FIREBASE_JWKS_RETRY", 30))
+FIREBASE_CLOCK_SKEW = int(os.environ.get("FIREBASE_CLOCK_SKEW", 0))
+
+# Signed GCS URLs last 7 days; each one is reused for SIGNED_URL_CACHE_TTL
+# seconds before it is signed again.
+SIGNED_URL_CACHE_SIZE = int(os.environ.get("SIGNED_URL_CACHE_SIZE", 50000))
+SIGNED_URL_CACHE_TTL = int(os.environ.get("SIGNED_URL_CACHE_TTL", 86400))
+SIGNING_EXECUTOR_WORKERS = int(os.environ.get("SIGNING_EXECUTOR_WORKERS", 2))
+
+# How many group_sends a fan-out keeps in flight at once.
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", 50))
+# Seconds to collect room refreshes before sending them as one room_refresh.
+ROOM_REFRESH_DEBOUNCE = float(os.environ.get("ROOM_REFRESH_DEBOUNCE", 0.05))
+# Replies a consumer addresses to itself skip the channel layer.
+DIRECT_SELF_DISPATCH = bool(os.environ.get("DIRECT_SELF_DISPATCH", "True") == "True")
+
+# Commands one socket may run at once, and how many it may have running or
+# waiting before further commands are rejected.
+COMMAND_CONCURRENCY = int(os.environ.get("COMMAND_CONCURRENCY", 4))
+COMMAND_QUEUE_SIZE = int(os.environ.get("COMMAND_QUEUE_SIZE", 32))
+
+# Room metadata is cached in-process for a few seconds and in the channel
+# layer's Redis for longer; writes invalidate both.
+ROOM_CACHE_SIZE = int(os.environ.get("ROOM_CACHE_SIZE", 10000))
+ROOM_CACHE_LOCAL_TTL = float(os.environ.get("ROOM_CACHE_LOCAL_TTL", 5))
+ROOM_CACHE_TTL = int(os.environ.get("ROOM_CACHE_TTL", 300))
+
+# Clients that negotiate paging get notification lists in pages and may ask
+# for pages up to the max; other clients get whole lists.
+NOTIFICATION_PAGE_SIZE = int(os.environ.get("NOTIFICATION_PAGE_SIZE", 50))
+NOTIFICATION_PAGE_SIZE_MAX = int(os.environ.get("NOTIFICATION_PAGE_SIZE_MAX", 200))
+
+# Per-command latency, query, channel layer and frame metrics, served as
+# Prometheus text at /metrics/. Off by default. Scrapers must send
+# "Authorization: Bearer <METRICS_TOKEN>" or connect from an address in
+# METRICS_ALLOWED_IPS (comma-separated addresses or networks); with neither
+# set the endpoint stays closed.
+METRICS_ENABLED = bool(os.environ.get("METRICS_ENABLED") == "True")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+METRICS_ALLOWED_IPS = [
+    network
+    for network in os.environ.get("METRICS_ALLOWED_IPS", "").split(",")
+    if network
+]
+
 CORS_ALLOW_ALL_ORIGINS = True
 
 if not LOCAL: